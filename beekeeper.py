@@ -3,18 +3,29 @@
 # self-identified schedule.
 
 # Usage:
-# python beekeeper.py <package_id> <field_name> <type (e.g., int)>
+# python beekeeper.py [beeswax file] [options] [check codes]
+# (Run "python beekeeper.py help" for the details.)
 
-import os, sys, json, requests, time, textwrap, traceback, ckanapi, fire
+import os, sys, io, re, json, time, hashlib, textwrap, traceback, threading, importlib
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from datetime import datetime, timedelta, date
-from dateutil import parser
 
 from copy import copy
+from contextlib import contextmanager, nullcontext
+from collections import Counter
+from operator import itemgetter
 
-from notify import send_to_slack
-from fetch import fetch_data_file, get_data_by_field
-from ckan_util import set_package_parameters_to_values, package_is_private, resource_is_private, get_all_resources, has_public_datastore, package_id_of, make_package_private
+from notify import NotificationQueue
+from references import ReferenceValues, DeferredReferenceValues
+import metrics
+from metrics import CheckMetrics, prometheus_text
+from scan import AdaptivePager, fetch_chunks, fetch_pages, fetch_chunks_by_id, fetch_chunks_in_ranges, ChunkFetchError, format_exception, sample_ids, chunked
+from sketches import ColumnProfile
+# ckan_util (which pulls in requests and ckanapi), fetch, and credentials
+# are imported by the functions that need them, so that listing or validating
+# the checks doesn't have to wait for them.
 
 from pprint import pprint
 try:
@@ -22,9 +33,24 @@ try:
 except ImportError:  # Graceful fallback if IceCream isn't installed.
     ic = lambda *a: None if not a else (a[0] if len(a) == 1 else a)  # noqa
 
+# Alerts are sent to Slack from a background thread, combined into digests
+# (one per channel every so often), so a run with many failures neither
+# waits on Slack nor runs into its rate limits.
+notifications = NotificationQueue()
+
 def buzz(mute_alerts, msg, username='beekeeper', channel='@david', icon=':bee:'):
     if not mute_alerts:
-        send_to_slack(msg, username, channel, icon)
+        notifications.put(msg, username, channel, icon)
+
+def alert(msg, **kwargs):
+    # When checks are run by mind_beeswax, each check collects its alerts
+    # in kwargs['alerts'], and they are sent together once the check is
+    # done, so that the alerts of checks running in parallel don't get
+    # interleaved.
+    if 'alerts' in kwargs:
+        kwargs['alerts'].append(msg)
+    else:
+        buzz(kwargs['mute_alerts'], msg)
 
 def get_archive_path():
     # Change path to script's path for cron job.
@@ -47,6 +73,28 @@ def load_from_json():
     else:
         return []
 
+def scan_state_key(b):
+    # The scan state of each check is stored under its code (or name) and
+    # resource ID, since a package-level check covers several resources.
+    return "{}:{}".format(b.get('code', b['name']), b['resource_id'])
+
+# The parameters of a check that decide whether a resource passes it. The
+# state recorded for a check is only used while these are the same as when
+# it was recorded (so editing a check's pattern, for instance, means that
+# the resource gets checked again).
+definition_parameters = ['field_name', 'assertion', 'post-loop_assertion', 'pattern', 'min', 'max', 'max_null_rate',
+    'thresholds', 'sketch_options', 'source_field_name', 'reference', 'count_duplicates']
+
+def check_definition(b):
+    definition = {p: b[p] for p in definition_parameters if p in b}
+    return hashlib.md5(json.dumps(definition, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def load_scan_state():
+    state = load_from_json()
+    if not isinstance(state, dict): # The default from load_from_json is a list.
+        return {}
+    return state
+
 def pluralize(word,xs,return_count=True,count=None):
     # This version of the pluralize function has been modified
     # to support returning or not returning the count
@@ -59,45 +107,209 @@ def pluralize(word,xs,return_count=True,count=None):
         return "{}{}".format(word,'' if count == 1 else 's')
 
 ## BEGIN Assertion Funtions ##
-def int_checker(x, reference_values):
+def is_int(x):
     try:
-        return type(int(x)) == int, reference_values
-    except ValueError:
-        print("int_checker has failed on a value of {}.".format(x))
-        return False, reference_values
+        return type(int(x)) == int
+    except (ValueError, TypeError): # A TypeError means the value is None.
+        return False
 
-def compare(xs, reference_values):
+def int_checker(x, reference_values):
+    if is_int(x):
+        return True, reference_values
+    print("int_checker has failed on a value of {}.".format(x))
+    return False, reference_values
+
+def compare(x, reference_values):
     # [ ] Since this, the second assertion function, does not do any actual assertions,
     # the "assertion" terminology below should be generalized.
     # operation_function? operation? record_level_operation?
-    new_reference_values = [r for r in reference_values if r not in xs]
-    return True, new_reference_values
+    reference_values.consume(x)
+    return True, reference_values
+
+def compare_chunk(xs, reference_values):
+    # Chunk-level version of compare, which strikes a whole page of
+    # datastore values from the reference values at once.
+    reference_values.consume_chunk(xs)
+    return True, reference_values
 
 def leftover_references(xs, reference_values):
-    if len(reference_values) != 0:
-        print(f"Here are the leftover reference values: {', '.join(reference_values)}")
-        print(f"This is a total of {len(reference_values)}.")
-    return len(reference_values) != 0, reference_values
+    leftovers = reference_values.leftovers()
+    if len(leftovers) != 0:
+        print(f"Here are the leftover reference values: {', '.join(leftovers)}")
+        print(f"This is a total of {len(leftovers)}.")
+    return len(leftovers) != 0, reference_values
+
+def null_rate_checker(max_null_rate):
+    # Post-loop assertion for the 'null_rate' batch assertion, which has
+    # counted the nulls as the scan went along.
+    def check_null_rate(xs, null_counts):
+        rate = null_counts['nulls']/null_counts['values'] if null_counts['values'] else 0
+        if rate > max_null_rate:
+            print("{} of {} values are null (a rate of {:.4f}, which is over the limit of {}).".format(null_counts['nulls'],
+                null_counts['values'], rate, max_null_rate))
+        return rate > max_null_rate, null_counts
+    return check_null_rate
+
+def profile_checker(thresholds):
+    # Post-loop assertion for the 'profile' batch assertion, which has
+    # gathered the column's statistics (a ColumnProfile) as the scan went
+    # along. thresholds maps statistic names to bounds, like
+    # {"null_rate": {"max": 0.05}, "p99": {"min": 1, "max": 500}}.
+    def check_profile(xs, profile):
+        statistics = {name: profile.statistic(name) for name in thresholds}
+        print("Profile: {}".format(', '.join("{} = {:.6g}".format(name, value) for name, value in statistics.items() if value is not None)))
+        print("Most frequent values: {}".format(', '.join("{!r} ({})".format(value, count) for value, count in profile.top_values())))
+        failed = False
+        for name, bounds in thresholds.items():
+            value = statistics[name]
+            if value is None:
+                print("There are no values to compute {} from.".format(name))
+                failed = True
+            elif bounds.get('min') is not None and value < bounds['min']:
+                print("{} is {:.6g}, which is below the limit of {}.".format(name, value, bounds['min']))
+                failed = True
+            elif bounds.get('max') is not None and value > bounds['max']:
+                print("{} is {:.6g}, which is above the limit of {}.".format(name, value, bounds['max']))
+                failed = True
+        return failed, profile
+    return check_profile
 ## END Assertion Funtions ##
 
-def functionalize(assertion):
+## BEGIN Batch Assertion Functions ##
+# Batch assertion functions take a whole chunk of values (a list) at a
+# time, so the work can be done by a few C-level operations (str methods
+# mapped over the chunk, set operations, min/max) instead of a Python
+# function call (and maybe an exception) per value.
+# Each returns (assertion_succeeded, reference_values), like the
+# per-value assertion functions do.
+
+def batch_adapter(assertion_function):
+    # Turns a per-value assertion function into a batch one.
+    def batch_assertion_function(xs, reference_values):
+        for x in xs:
+            assertion_succeeded, reference_values = assertion_function(x, reference_values)
+            if not assertion_succeeded:
+                return False, reference_values
+        return True, reference_values
+    return batch_assertion_function
+
+def int_checker_batch(xs, reference_values):
+    # If every value in the chunk is a string of decimal digits (which is
+    # checked by a single C-level pass), every value passes. Otherwise
+    # (which includes values that int() accepts but str.isdecimal doesn't,
+    # like ' 15213' or '-4' or an actual integer), the values are checked
+    # one at a time to find any that fail.
+    try:
+        if all(map(str.isdecimal, xs)):
+            return True, reference_values
+    except TypeError: # Some values are not strings.
+        pass
+    return batch_adapter(int_checker)(xs, reference_values)
+
+def regex_matcher(pattern):
+    compiled = re.compile(pattern)
+    def match_chunk(xs, reference_values):
+        # A None fails (as NULL does in the server-side version of this
+        # check), even if the pattern would match an empty string.
+        for x in xs:
+            if x is None or compiled.fullmatch(str(x)) is None:
+                print("regex_matcher has failed on a value of {}.".format(x))
+                return False, reference_values
+        return True, reference_values
+    return match_chunk
+
+def range_checker(minimum=None, maximum=None):
+    def check_chunk_range(xs, reference_values):
+        if len(xs) == 0:
+            return True, reference_values
+        try:
+            numbers = list(map(float, xs))
+        except (ValueError, TypeError):
+            print("range_checker has failed on a value that is not a number.")
+            return False, reference_values
+        low, high = min(numbers), max(numbers)
+        if minimum is not None and low < minimum:
+            print("range_checker has failed on a value of {}, which is below {}.".format(low, minimum))
+            return False, reference_values
+        if maximum is not None and high > maximum:
+            print("range_checker has failed on a value of {}, which is above {}.".format(high, maximum))
+            return False, reference_values
+        return True, reference_values
+    return check_chunk_range
+
+def count_nulls(xs, null_counts):
+    null_counts['values'] += len(xs)
+    null_counts['nulls'] += len(xs) - len([x for x in xs if x is not None and x != ''])
+    return True, null_counts
+
+def update_profile(xs, profile):
+    profile.update(xs)
+    return True, profile
+## END Batch Assertion Functions ##
+
+def functionalize(assertion, b=None):
+    # Parameterized assertions (like 'max_null_rate') get their parameters
+    # from the beeswax entry b.
     if assertion == 'int':
         return int_checker
     if assertion == 'contains_values':
         return compare
     if assertion == 'leftover_references':
         return leftover_references
+    if assertion == 'max_null_rate':
+        return null_rate_checker(b['max_null_rate'])
+    if assertion == 'profile_thresholds':
+        return profile_checker(b['thresholds'])
     raise ValueError("No function currently assigned to {}.".format(assertion))
 
-def get_number_of_rows(site,resource_id,API_key=None):
+def batch_functionalize(b):
+    # Returns the batch assertion function for the beeswax entry b, falling
+    # back to running the per-value function from functionalize on each
+    # value in the chunk.
+    assertion = b['assertion']
+    if assertion == 'int':
+        return int_checker_batch
+    if assertion == 'contains_values':
+        return compare_chunk
+    if assertion == 'regex':
+        return regex_matcher(b['pattern'])
+    if assertion == 'range':
+        return range_checker(b.get('min'), b.get('max'))
+    if assertion == 'null_rate':
+        return count_nulls
+    if assertion == 'profile':
+        return update_profile
+    return batch_adapter(functionalize(assertion, b))
+
+def value_checker(b):
+    # Returns a function that tells whether a single value passes the
+    # assertion of the beeswax entry b, without printing anything (for
+    # finding the rows to blame for a chunk whose failure has already been
+    # reported), or None if the assertion has no such version.
+    assertion = b['assertion']
+    if assertion == 'int':
+        return is_int
+    if assertion == 'regex':
+        compiled = re.compile(b['pattern'])
+        return lambda x: x is not None and compiled.fullmatch(str(x)) is not None
+    if assertion == 'range':
+        minimum, maximum = b.get('min'), b.get('max')
+        def in_range(x):
+            try:
+                number = float(x)
+            except (ValueError, TypeError):
+                return False
+            return (minimum is None or number >= minimum) and (maximum is None or number <= maximum)
+        return in_range
+    return None
+
+def get_number_of_rows(site,resource_id,API_key=None,ckan=None):
     """Returns the number of rows in a datastore. Note that even when there is a limit
     placed on the number of results a CKAN API call can return, this function will
     still give the true number of rows."""
-    ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
-    results_dict = ckan.action.datastore_info(id = resource_id)
+    from ckan_util import get_datastore_info
     try:
-        ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
-        results_dict = ckan.action.datastore_info(id = resource_id)
+        results_dict = get_datastore_info(site, resource_id, API_key, ckan)
         return results_dict['meta']['count']
     except:
         return None
@@ -112,29 +324,34 @@ def get_number_of_rows(site,resource_id,API_key=None):
 #                              'OwnerZip': 'text',
 #                              'ValidDate': 'text'}}
 #
-# [ ] So, both the schema and the count could be obtained in one call.
-
-def get_schema(site, resource_id, API_key=None):
-    # In principle, it should be possible to do this using the datastore_info
-    # endpoint instead and taking the 'schema' part of the result.
+# so both the schema and the count are obtained from one (cached) call.
+# (Newer versions of CKAN return a 'fields' list instead of 'schema'.)
 
+def get_schema(site, resource_id, API_key=None, ckan=None):
     # schema is a list of entries like this:
     #       {'id': 'zip', 'type': 'text'},
+    from ckan_util import get_datastore_info
     try:
-        ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
-        results_dict = ckan.action.datastore_search(resource_id=resource_id,limit=0)
-        schema = results_dict['fields']
+        results_dict = get_datastore_info(site, resource_id, API_key, ckan)
+        if 'fields' in results_dict:
+            schema = [{'id': f['id'], 'type': f['type']} for f in results_dict['fields']]
+        else:
+            schema = [{'id': k, 'type': v} for k, v in results_dict['schema'].items()]
+        if '_id' not in [s['id'] for s in schema]: # datastore_info leaves out _id,
+            schema = [{'id': '_id', 'type': 'int'}] + schema # but datastore_search doesn't.
     except:
         return None
 
     return schema
 
-def get_resource_data(site,resource_id,API_key=None,count=50,offset=0,fields=None):
+def get_resource_data(site,resource_id,API_key=None,count=50,offset=0,fields=None,ckan=None):
     # Use the datastore_search API endpoint to get <count> records from
     # a CKAN resource starting at the given offset and only returning the
     # specified fields in the given order (defaults to all fields in the
     # default datastore order).
-    ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
+    if ckan is None:
+        from ckan_util import get_ckan
+        ckan = get_ckan(site, API_key)
     if fields is None:
         response = ckan.action.datastore_search(id=resource_id, limit=count, offset=offset)
     else:
@@ -164,119 +381,853 @@ def get_resource_data(site,resource_id,API_key=None,count=50,offset=0,fields=Non
     data = response['records']
     return data
 
+def get_resource_data_by_ids(site,resource_id,ids,API_key=None,fields=None,ckan=None):
+    # Use the datastore_search API endpoint to get the records with the
+    # given _id values (the _id filter becomes an IN clause).
+    if ckan is None:
+        from ckan_util import get_ckan
+        ckan = get_ckan(site, API_key)
+    if fields is None:
+        response = ckan.action.datastore_search(id=resource_id, filters={'_id': list(ids)}, limit=len(ids))
+    else:
+        response = ckan.action.datastore_search(id=resource_id, filters={'_id': list(ids)}, limit=len(ids), fields=fields)
+    data = response['records']
+    return data
+
+def get_min_id(site,resource_id,API_key=None,ckan=None):
+    # Returns the lowest _id in the datastore (or 0 if it's empty).
+    if ckan is None:
+        from ckan_util import get_ckan
+        ckan = get_ckan(site, API_key)
+    response = ckan.action.datastore_search(id=resource_id, limit=1, fields=['_id'], sort='_id asc')
+    records = response['records']
+    return records[0]['_id'] if records else 0
+
+def get_max_id(site,resource_id,API_key=None,ckan=None):
+    # Returns the highest _id in the datastore (or 0 if it's empty).
+    if ckan is None:
+        from ckan_util import get_ckan
+        ckan = get_ckan(site, API_key)
+    response = ckan.action.datastore_search(id=resource_id, limit=1, fields=['_id'], sort='_id desc')
+    records = response['records']
+    return records[0]['_id'] if records else 0
+
+def quote_identifier(name):
+    # Double-quote a table or column name for use in datastore_search_sql.
+    return '"{}"'.format(name.replace('"', '""'))
+
+def get_resource_data_after_id(site,resource_id,API_key=None,count=50,last_id=0,fields=None,ckan=None,up_to_id=None):
+    # Use the datastore_search_sql API endpoint to get the <count> records
+    # with the lowest _id values above last_id (and, if up_to_id is given,
+    # no higher than that). Unlike a deep OFFSET (which makes Postgres walk
+    # past every skipped row), this is an index range scan on _id, so every
+    # page costs about the same no matter how far into the table it is. The
+    # _id field is always returned (first), since it is needed to request
+    # the next page.
+    if ckan is None:
+        from ckan_util import get_ckan
+        ckan = get_ckan(site, API_key)
+    if fields is None:
+        columns = '*'
+    else:
+        columns = ', '.join(quote_identifier(f) for f in ['_id'] + [f for f in fields if f != '_id'])
+    condition = '"_id" > {}'.format(int(last_id))
+    if up_to_id is not None:
+        condition += ' AND "_id" <= {}'.format(int(up_to_id))
+    sql = 'SELECT {} FROM {} WHERE {} ORDER BY "_id" LIMIT {}'.format(columns,
+            quote_identifier(resource_id), condition, int(count))
+    response = ckan.action.datastore_search_sql(sql=sql)
+    data = response['records']
+    return data
+
+def count_rows_up_to(site,resource_id,last_id,API_key=None,ckan=None):
+    # Returns the number of rows with _id values up to last_id (or None if
+    # datastore_search_sql can't be used to count them).
+    from ckanapi.errors import CKANAPIError
+    if ckan is None:
+        from ckan_util import get_ckan
+        ckan = get_ckan(site, API_key)
+    sql = 'SELECT COUNT(*) AS "count" FROM {} WHERE "_id" <= {}'.format(quote_identifier(resource_id), int(last_id))
+    try:
+        response = ckan.action.datastore_search_sql(sql=sql)
+    except CKANAPIError:
+        return None
+    return int(response['records'][0]['count'])
+
+def quote_literal(value):
+    # Single-quote a string for use in datastore_search_sql.
+    return "'{}'".format(str(value).replace("'", "''"))
+
+def range_condition(column, b):
+    conditions = ["{} IS NULL".format(column)]
+    if b.get('min') is not None:
+        conditions.append("{}::numeric < {}".format(column, float(b['min'])))
+    if b.get('max') is not None:
+        conditions.append("{}::numeric > {}".format(column, float(b['max'])))
+    return ' OR '.join(conditions)
+
+# SQL conditions which pick out the rows that an assertion would fail on,
+# for the assertions that can be evaluated by the datastore itself.
+# Each one takes the (quoted) column name and the beeswax entry.
+sql_failure_conditions = {
+    'int': lambda column, b: "{0} IS NULL OR {0}::text !~ '^\\s*[-+]?[0-9]+\\s*$'".format(column),
+    'regex': lambda column, b: "{0} IS NULL OR {0}::text !~ {1}".format(column, quote_literal('^(?:{})$'.format(b['pattern']))),
+    'range': range_condition,
+    }
+
+def id_ranges_condition(ranges):
+    # An SQL condition that picks out the rows in the given (first _id,
+    # last _id) ranges.
+    return ' OR '.join('"_id" BETWEEN {} AND {}'.format(int(low), int(high)) for low, high in ranges)
+
+# How many offending rows are collected (whether by a scan or by the
+# datastore) unless the beeswax entry sets 'max_failures'.
+default_max_failures = 10
+
+def find_failures_on_server(site,resource_id,field_name,b,API_key=None,last_id=0,sample_size=default_max_failures,ckan=None,ranges=None):
+    # Use the datastore_search_sql API endpoint to count the rows (with _id
+    # values above last_id, and in the given _id ranges, if any) on which
+    # the assertion fails, returning that count along with a sample of up
+    # to <sample_size> of the offending rows.
+    # Since the window function is evaluated before the LIMIT, one query
+    # gives both.
+    if ckan is None:
+        from ckan_util import get_ckan
+        ckan = get_ckan(site, API_key)
+    column = quote_identifier(field_name)
+    condition = sql_failure_conditions[b['assertion']](column, b)
+    if ranges:
+        condition = "({}) AND ({})".format(id_ranges_condition(ranges), condition)
+    sql = 'SELECT "_id", {0}, COUNT(*) OVER () AS "_failures" FROM {1} WHERE "_id" > {2} AND ({3}) ORDER BY "_id" LIMIT {4}'.format(column,
+            quote_identifier(resource_id), int(last_id), condition, int(sample_size))
+    response = ckan.action.datastore_search_sql(sql=sql)
+    records = response['records']
+    failure_count = int(records[0]['_failures']) if records else 0
+    return failure_count, [{'_id': r['_id'], field_name: r[field_name]} for r in records]
+
+def apply_assertion_on_server(site, b, resource_id, field_name, API_key=None, last_id=0, progress=None, ckan=None, ranges=None):
+    # Returns True if the assertion holds for every row, False if it doesn't,
+    # and None if the question can't be put to the datastore (like when
+    # datastore_search_sql has been disabled on the CKAN instance), in
+    # which case the caller should fall back to scanning the records.
+    # The sample of offending rows goes in progress['offending_rows'].
+    from ckanapi.errors import CKANAPIError
+    if progress is None:
+        progress = {}
+    try:
+        failure_count, samples = find_failures_on_server(site, resource_id, field_name, b, API_key, last_id,
+                sample_size=b.get('max_failures', default_max_failures), ckan=ckan, ranges=ranges)
+    except CKANAPIError:
+        print(format_exception())
+        print("Unable to evaluate the assertion with datastore_search_sql, so the records will be scanned instead.")
+        return None
+    if failure_count > 0:
+        print("The assertion '{}' fails on {}. Here are some of them:".format(b['assertion'], pluralize('row', None, count=failure_count)))
+        for sample in samples:
+            print("    _id {}: {}".format(sample['_id'], sample[field_name]))
+        progress['offending_rows'] = [{'_id': sample['_id'], 'value': sample[field_name]} for sample in samples]
+    return failure_count == 0
+
+def get_fingerprints(site, resource_id, field_name, range_size=10000, API_key=None, ckan=None):
+    # Has the datastore hash the values of the field (along with their _id
+    # values) in each range of range_size _id values, with one
+    # datastore_search_sql query, and returns them as fingerprints (see
+    # fingerprints.py). Returns None if the query can't be run (like when
+    # datastore_search_sql has been disabled or doesn't allow md5) or if
+    # the results were cut short.
+    # The query reads the whole table, so its results are cached (like the
+    # resource metadata), and the checks of the same field of a resource
+    # in a run share one.
+    from ckan_util import metadata_cache
+    return metadata_cache.get((site, 'fingerprints', resource_id, field_name, int(range_size)),
+            lambda: compute_fingerprints(site, resource_id, field_name, range_size, API_key, ckan))
+
+def compute_fingerprints(site, resource_id, field_name, range_size=10000, API_key=None, ckan=None):
+    from ckanapi.errors import CKANAPIError
+    from fingerprints import make_fingerprints
+    if ckan is None:
+        from ckan_util import get_ckan
+        ckan = get_ckan(site, API_key)
+    row = '"_id"::text || \':\' || quote_nullable({}::text)'.format(quote_identifier(field_name))
+    sql = 'SELECT ("_id" - 1) / {0} AS "range", md5(string_agg({1}, \',\' ORDER BY "_id")) AS "hash" FROM {2} GROUP BY 1 ORDER BY 1'.format(int(range_size),
+            row, quote_identifier(resource_id))
+    try:
+        response = ckan.action.datastore_search_sql(sql=sql)
+    except CKANAPIError:
+        print(format_exception())
+        print("Unable to compute fingerprints with datastore_search_sql.")
+        return None
+    if response.get('records_truncated'):
+        print("There are too many ranges to fingerprint (so 'fingerprint_range' should be raised).")
+        return None
+    return make_fingerprints(field_name, range_size, {str(r['range']): r['hash'] for r in response['records']})
+
 def select(field_name, record):
     return record[field_name]
 
-def apply_function_to_all_records(site, b, resource_id, field_name, assertion_function, reference_values, API_key=None, chunk_size=5000):
-    all_records = []
-    assertion_failed = False
-    failures = 0
-    k = 0
-    offset = 0 # offset is almost k*chunk_size (but not quite)
-    row_count = get_number_of_rows(site, resource_id, API_key)
-    if row_count == 0: # or if the datastore is not active
-        print("No data found in the datastore.")
+def find_offending_rows(value_check, assertion_function, values, ids, reference_values):
+    # Check each value of a chunk that failed the assertion, to find which
+    # rows are to blame, with the quiet per-value version of the assertion
+    # (see value_checker) if there is one.
+    if value_check is None:
+        value_check = lambda value: assertion_function([value], reference_values)[0]
+    return [{'_id': _id, 'value': value} for _id, value in zip(ids, values) if not value_check(value)]
+
+# Scan strategies:
+#   'full': check every row (stopping at the first failure).
+#   'sample': check a stratified random sample of 'sample_size' rows,
+#       spread across the whole _id space.
+#   'head_tail_sample': check the first and last 'head_tail_size' rows plus
+#       a stratified random sample.
+#   'first_failures': check every row, but keep going after a failure, until
+#       'max_failures' offending rows have been collected (for the alert).
+scan_strategies = ['full', 'sample', 'head_tail_sample', 'first_failures']
+
+class AssertionScan():
+    """The assertion of one check, applied chunk by chunk to a scan of its
+    resource. Several AssertionScans can be fed the same chunks, so that
+    checks of the same resource share one scan.
+
+    Each chunk is reduced to the values in field_name (so the records
+    themselves can be let go of as soon as every check has seen them).
+    Rows with _id values up to start_id are left out, since they were
+    already checked on an earlier run. Once the assertion has failed (or,
+    for the 'first_failures' strategy, max_failures offending rows have
+    been found), the check is done and wants no more chunks. The offending
+    rows go in progress['offending_rows'], and, when keyset paging, the
+    _id of the last record that made it through the assertion function is
+    kept in progress['last_id'].
+
+    Anything the check prints while working through a chunk goes wherever
+    it would within the context (a context manager factory) it is given."""
+    def __init__(self, b, field_name, assertion_function, reference_values, progress, strategy='full',
+            start_id=0, check_metrics=None, context=nullcontext):
+        self.b = b
+        self.field_name = field_name
+        self.select_field = itemgetter(field_name) # A faster select(field_name, record)
+        self.assertion_function = assertion_function
+        self.reference_values = reference_values
+        self.progress = progress
+        self.strategy = strategy
+        self.start_id = start_id
+        self.check_metrics = check_metrics or metrics.current()
+        self.context = context
+        self.max_failures = b.get('max_failures', default_max_failures)
+        self.value_check = value_checker(b) if strategy == 'first_failures' else None
+        self.values_seen = 0
+        self.chunks_seen = 0
+        self.assertion_failed = False
+        self.error = None
+        self.done = False
+
+    def needs_ids(self):
+        return self.strategy == 'first_failures' or self.start_id > 0
+
+    def consume(self, key, records, paging):
+        values = list(map(self.select_field, records))
+        ids = list(map(itemgetter('_id'), records)) if self.needs_ids() else None
+        if self.start_id > 0 and ids and ids[0] <= self.start_id:
+            kept = [k for k, _id in enumerate(ids) if _id > self.start_id]
+            values, ids = [values[k] for k in kept], [ids[k] for k in kept]
+        # The assertion function is a batch one, which takes the whole chunk of values.
+        # When using 'contains_values', the action of the assertion function is to strike the values
+        # pulled from a page of CKAN records from the set of reference values (values from the FTP
+        # source file). THEN the post-loop assertion checks that nothing is left over.
+        cpu_start = time.thread_time()
+        assertion_succeeded, self.reference_values = self.assertion_function(values, self.reference_values)
+        self.check_metrics.record_assertion(time.thread_time() - cpu_start)
+        if not assertion_succeeded:
+            self.assertion_failed = True
+            if self.strategy == 'first_failures':
+                offending_rows = self.progress.setdefault('offending_rows', [])
+                offending_rows += find_offending_rows(self.value_check, self.assertion_function, values, ids, self.reference_values)
+                del offending_rows[self.max_failures:]
+        self.values_seen += len(values)
+        self.chunks_seen += 1
+        self.check_metrics.record_rows(len(values))
+        if paging == 'keyset' and not self.assertion_failed:
+            self.progress['last_id'] = key
+        if self.assertion_failed and (self.strategy != 'first_failures' or len(self.progress['offending_rows']) >= self.max_failures):
+            self.done = True
+
+    def finish(self, row_count, paging, fetch_failed):
+        # If the number of rows is a moving target, the row count could be
+        # refetched here and the scan extended to cover the new rows.
+        if (not self.assertion_failed and not fetch_failed and self.strategy == 'full' and paging == 'offset' and self.start_id == 0
+                and row_count is not None and self.values_seen != row_count):
+            print(f"\nThe datastore was expected to have {row_count} rows, but {self.values_seen} values were checked (in {self.chunks_seen} chunks).")
+
+        # Post-loop check (like when verifying that all reference values are contained within a column of the dataset) should be done here.
+        if 'post-loop_assertion' in self.b:
+            final_assertion_function = functionalize(self.b['post-loop_assertion'], self.b)
+            post_loop_assertion_failed, self.reference_values = final_assertion_function([], self.reference_values)
+            self.assertion_failed = self.assertion_failed or post_loop_assertion_failed
+
+        if self.assertion_failed:
+            return False
+
+        if fetch_failed:
+            raise ValueError("apply_function_to_all_records() failed to get all the records.")
         return True
 
+def fetch_resource_chunks(site, b, resource_id, fields, row_count, API_key=None, chunk_size=5000, strategy='full', paging='offset', start_id=0, ckan=None, ranges=None):
+    # Returns a generator of (key, records) pairs covering the datastore (or
+    # the sample of it called for by the strategy, or just the rows in the
+    # given (first _id, last _id) ranges), with each record having the given
+    # fields.
+    # Since the number of rows is known up front, several pages can be in
+    # flight at once. The concurrency and request rate can be tuned per
+    # beeswax entry. The page size starts at chunk_size (or the entry's
+    # 'chunk_size') and then grows while the server answers quickly and
+    # shrinks when it slows down or fails (see AdaptivePager).
+    # The pages are fetched without the client's own retries of 429/5xx
+    # responses, so that the pager and the scan's backoff see those.
+    if ckan is None:
+        from ckan_util import get_ckan
+        ckan = get_ckan(site, API_key)
     failure_limit = 5
-    while len(all_records) < row_count and failures < failure_limit and not assertion_failed:
-        time.sleep(0.1)
-        try:
-            records = get_resource_data(site, resource_id, API_key, chunk_size, offset, [field_name])
-            for record in records:
-                assertion_succeeded, reference_values = assertion_function(select(field_name, record), reference_values)
-                # When using 'contains_values', the action of the assertion function is to reduce the list of reference
-                # values (values from the FTP source file) by the value pulled from a CKAN record:
-                #    new_reference_values = [r for r in reference_values if r not in xs]
-                # THEN the post-loop assertion checks that new_reference_values has been reduced to an empty list.
-                if not assertion_succeeded:
-                    assertion_failed = True
-                    break
-            if records is not None:
-                all_records += records
-            failures = 0
-            offset += chunk_size
+    check_metrics = metrics.current()
+    page = lambda fetch_chunk: check_metrics.page(ckan.without_status_retries(fetch_chunk))
+    pager = AdaptivePager(b.get('chunk_size', chunk_size), min_size=b.get('min_chunk_size', 100),
+            max_size=b.get('max_chunk_size', 32000), target_seconds=b.get('target_page_seconds', 2.0),
+            adaptive=b.get('adaptive_paging', True))
+    if ranges:
+        # Each range is walked in _id order (rather than every _id in it
+        # being listed and asked for).
+        print(f"Checking the rows in {pluralize('range', ranges)} of _id values ({sum(high - low + 1 for low, high in ranges)} _id values).")
+        fetch_chunk = lambda last_id, high, limit: get_resource_data_after_id(site, resource_id, API_key, limit, last_id, fields, ckan, high)
+        return fetch_chunks_in_ranges(page(fetch_chunk), ranges, start_id, pager,
+                requests_per_second=b.get('requests_per_second', 10), failure_limit=failure_limit, metrics=check_metrics)
+    if strategy in ['sample', 'head_tail_sample']:
+        head_tail_size = b.get('head_tail_size', 1000) if strategy == 'head_tail_sample' else 0
+        ids = sample_ids(get_min_id(site, resource_id, API_key, ckan), get_max_id(site, resource_id, API_key, ckan),
+                b.get('sample_size', 10000), head_tail_size)
+        print(f"Checking a sample of {len(ids)} of the {row_count} rows.")
+        fetch_chunk = lambda chunk_ids: get_resource_data_by_ids(site, resource_id, chunk_ids, API_key, fields, ckan)
+        return fetch_chunks(page(fetch_chunk), chunked(ids, min(pager.size, 1000)), concurrency=b.get('concurrency', 4),
+                requests_per_second=b.get('requests_per_second', 10), failure_limit=failure_limit, metrics=check_metrics)
+    if paging == 'keyset':
+        fetch_chunk = lambda last_id, limit: get_resource_data_after_id(site, resource_id, API_key, limit, last_id, fields, ckan)
+        chunks = fetch_chunks_by_id(page(fetch_chunk), start_id, pager,
+                requests_per_second=b.get('requests_per_second', 10), failure_limit=failure_limit, metrics=check_metrics)
+        def offset_chunks():
+            # The pages are fetched one at a time (so that they arrive in
+            # _id order) and keyed by their last _id, like keyset chunks.
+            fetch_page = lambda offset, limit: get_resource_data(site, resource_id, API_key, limit, offset, ['_id'] + [f for f in fields if f != '_id'], ckan)
+            pages = fetch_pages(page(fetch_page), row_count, pager, concurrency=1, requests_per_second=b.get('requests_per_second', 10),
+                    failure_limit=failure_limit, metrics=check_metrics)
+            try:
+                for offset, records in pages:
+                    if records:
+                        yield records[-1]['_id'], records
+            finally:
+                pages.close()
+        return with_fallback(chunks, offset_chunks)
+    if paging == 'offset':
+        # To start after an _id, the pages start at the number of rows up to
+        # it (and the scans drop any earlier rows that still come back).
+        start_offset = (count_rows_up_to(site, resource_id, start_id, API_key, ckan) or 0) if start_id > 0 else 0
+        fetch_chunk = lambda offset, limit: get_resource_data(site, resource_id, API_key, limit, offset, fields, ckan)
+        return fetch_pages(page(fetch_chunk), row_count, pager, concurrency=b.get('concurrency', 4),
+                requests_per_second=b.get('requests_per_second', 10), failure_limit=failure_limit, metrics=check_metrics, start_offset=start_offset)
+    raise ValueError(f"Unknown paging mode '{paging}'.")
+
+def with_fallback(chunks, fallback):
+    # Yields the chunks of a keyset walk, unless the datastore refuses the
+    # first request (like when datastore_search_sql has been turned off),
+    # in which case the chunks from fallback() (offset paging) are yielded
+    # instead.
+    try:
+        first = next(chunks, None)
+    except ChunkFetchError as e:
+        if getattr(e.__cause__, 'retryable', True):
+            raise
+        chunks.close()
+        print("Unable to page through the datastore with datastore_search_sql, so it will be paged by offset instead.")
+        chunks = fallback()
+        first = next(chunks, None)
+    try:
+        if first is not None:
+            yield first
+            yield from chunks
+    finally:
+        chunks.close()
+
+def apply_assertion_scans(site, b, resource_id, scans, API_key=None, chunk_size=5000, strategy='full', ckan=None, snapshots=None, last_modified=None, ranges=None):
+    # Runs one scan of the resource (with the fetching settings of the
+    # beeswax entry b) and feeds every chunk to each of the AssertionScans
+    # that still wants it, fetching only the fields that they look at. The
+    # scan stops once all of them are done. Returns the result of each
+    # one's assertion, like apply_function_to_all_records does (with a
+    # ValueError in place of a result if the records couldn't all be
+    # fetched, or the exception that a check raised, which ends just that
+    # check).
+    # If snapshots (a SnapshotCache) is given, and it has an up-to-date
+    # snapshot of the resource (by last_modified and row count) with the
+    # needed fields, the chunks are read from that instead (every row of
+    # it, whatever the strategy). Otherwise, a full scan is stored as a new
+    # snapshot, and so it runs to the end even after the assertions are
+    # done. (A beeswax entry can set 'snapshot' to False to opt out.)
+    # If ranges (a list of (first _id, last _id) pairs) is given, only the
+    # rows in those ranges are checked (and snapshots aren't used, since the
+    # rows have changed without necessarily changing the resource).
+    if strategy not in scan_strategies:
+        raise ValueError(f"Unknown scan strategy '{strategy}'.")
+    paging = b.get('paging', 'offset')
+    row_count = get_number_of_rows(site, resource_id, API_key, ckan)
+    if row_count == 0: # or if the datastore is not active
+        print("No data found in the datastore.")
+        return [True for scan in scans]
+    if row_count is None:
+        raise ValueError(f"Unable to get the number of rows in the datastore for resource {resource_id}.")
+
+    field_names = []
+    for scan in scans:
+        if scan.field_name not in field_names:
+            field_names.append(scan.field_name)
+    needs_ids = any(scan.needs_ids() for scan in scans)
+    if paging == 'keyset': # The _id field always comes back first when keyset paging.
+        fields = field_names
+    else:
+        fields = (['_id'] if needs_ids else []) + [f for f in field_names if f != '_id']
+    start_id = min(scan.start_id for scan in scans)
+
+    snapshot = snapshot_writer = None
+    if snapshots is not None and last_modified is not None and b.get('snapshot', True) and not ranges:
+        snapshot = snapshots.find(resource_id, last_modified, row_count, field_names)
+        if snapshot is not None:
+            print(f"Reading the snapshot of this resource that was stored at {snapshot.manifest['stored_at']}.")
+        elif strategy in ['full', 'first_failures'] and start_id == 0:
+            if paging != 'keyset' and '_id' not in fields:
+                fields = ['_id'] + fields
+            snapshot_writer = snapshots.writer(resource_id, last_modified, row_count, fields, get_schema(site, resource_id, API_key, ckan))
+
+    # Scanning is a pipeline of generators (fetch a chunk, select the field,
+    # apply the assertion, discard the chunk), so only one chunk per request
+    # in flight is held in memory at a time and all that is kept from the
+    # scan itself is a few counters.
+    fetch_failed = False
+    if snapshot is not None:
+        chunks = snapshot.chunks(['_id'] + [f for f in field_names if f != '_id'], b.get('chunk_size', chunk_size), paging)
+    else:
+        chunks = fetch_resource_chunks(site, b, resource_id, fields, row_count, API_key, chunk_size, strategy, paging, start_id, ckan, ranges)
+    try:
+        for key, records in chunks: # Chunks arrive in whatever order they finish in.
+            for scan in scans:
+                if not scan.done:
+                    with scan.context():
+                        try:
+                            scan.consume(key, records, paging)
+                        except Exception as e: # (Like a reference file that couldn't be fetched.)
+                            # This check is done for, but the others sharing the scan go on.
+                            print(format_exception())
+                            scan.error = e
+                            scan.done = True
+            if snapshot_writer is not None:
+                snapshot_writer.add(key, records)
             print('.', end = '', flush = True)
-        except:
-            e = sys.exc_info()[0]
-            msg = "Error: {} : \n".format(e)
-            exc_type, exc_value, exc_traceback = sys.exc_info()
-            lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
-            msg = ''.join('!! ' + line for line in lines)
-            print(msg) # Dump exception details to the console.
-            failures += 1
-
-        # If the number of rows is a moving target, incorporate
-        # this step:
-        #row_count = get_number_of_rows(site,resource_id,API_key)
-        k += 1
-        #print("{} iterations, {} failures, {} records, {} total records".format(k, failures, len(records) if records is not None else 0, len(all_records)))
-
-        # Another option for iterating through the records of a resource would be to
-        # just iterate through using the _links results in the API response:
-        #    "_links": {
-        #  "start": "/api/action/datastore_search?limit=5&resource_id=5bbe6c55-bce6-4edb-9d04-68edeb6bf7b1",
-        #  "next": "/api/action/datastore_search?offset=5&limit=5&resource_id=5bbe6c55-bce6-4edb-9d04-68edeb6bf7b1"
-        # Like this:
-            #if r.status_code != 200:
-            #    failures += 1
-            #else:
-            #    URL = site + result["_links"]["next"]
-
-        # Information about better ways to handle requests exceptions:
-        #http://stackoverflow.com/questions/16511337/correct-way-to-try-except-using-python-requests-module/16511493#16511493
-
-    # Post-loop check (like when verifying that all reference values are contained within a column of the dataset) should be done here.
-    if 'post-loop_assertion' in b:
-        final_assertion_function = functionalize(b['post-loop_assertion'])
-        post_loop_assertion_failed, reference_values = final_assertion_function([], reference_values)
-        assertion_failed = assertion_failed or post_loop_assertion_failed
-
-    if assertion_failed:
-        return False
+            if all(scan.done for scan in scans) and (snapshot_writer is None or snapshot_writer.failed):
+                break
+    except ChunkFetchError:
+        print(format_exception())
+        if paging == 'keyset':
+            resumable = [scan.progress['last_id'] for scan in scans if 'last_id' in scan.progress]
+            if resumable:
+                print(f"The scan can be resumed after _id {min(resumable)}.")
+        fetch_failed = True
+    finally:
+        chunks.close()
+        if snapshot_writer is not None:
+            if fetch_failed:
+                snapshot_writer.abandon()
+            else:
+                snapshot_writer.commit()
+
+    results = []
+    for scan in scans:
+        if scan.error is not None:
+            results.append(scan.error)
+            continue
+        with scan.context():
+            try:
+                results.append(scan.finish(None if ranges else row_count, paging, fetch_failed))
+            except Exception as e: # (Like a reference file that failed to download after the last chunk.)
+                results.append(e)
+    return results
+
+def apply_function_to_all_records(site, b, resource_id, field_name, assertion_function, reference_values, API_key=None, chunk_size=5000, progress=None, strategy='full', ckan=None, snapshots=None, last_modified=None):
+    # If the beeswax entry sets 'paging' to 'keyset', the datastore is walked
+    # in _id order (_id > last _id seen) instead of by OFFSET. In that mode,
+    # the _id of the last record that made it through the assertion function
+    # is kept in progress['last_id']. A scan (in either mode) that is handed
+    # a progress dict which already has a 'last_id' starts after it rather
+    # than at the beginning.
+    # Any offending rows collected by the 'first_failures' strategy end up
+    # in progress['offending_rows']. If progress has 'ranges' (of _id
+    # values, like the ones whose fingerprints have changed), only the rows
+    # in those ranges are checked.
+    if progress is None:
+        progress = {}
+    start_id = progress.get('last_id', 0)
+    scan = AssertionScan(b, field_name, assertion_function, reference_values, progress, strategy, start_id)
+    result, = apply_assertion_scans(site, b, resource_id, [scan], API_key, chunk_size, strategy, ckan, snapshots, last_modified, progress.get('ranges'))
+    if isinstance(result, Exception):
+        raise result
+    return result
 
-    if failures == failure_limit:
-        raise ValueError("apply_function_to_all_records() failed to get all the records.")
-    return not assertion_failed
+# The treatments that a beeswax entry can name (as its 'treatment'), each
+# mapped to the module and name of the function (which takes the beeswax
+# entry) that applies it. The module is only imported if the treatment
+# actually gets applied.
+treatments = {
+    'make_package_private': ('ckan_util', 'make_package_private'),
+    }
+
+def get_treatment(treatment):
+    # A treatment can also be given as the function itself.
+    if callable(treatment):
+        return treatment
+    if treatment not in treatments:
+        raise ValueError("Unknown treatment '{}'. (The known treatments are {}.)".format(treatment, ', '.join(sorted(treatments))))
+    module_name, function_name = treatments[treatment]
+    return getattr(importlib.import_module(module_name), function_name)
 
 def apply_treatment(b, **kwargs):
     if 'treatment' in b:
-        msg = "As a response to {} failing its assertion, {} is being applied.".format(b, b['treatment'])
+        treatment = get_treatment(b['treatment'])
+        msg = "As a response to {} failing its assertion, {} is being applied.".format(b.get('code', b['name']), treatment.__name__)
         print(msg)
-        buzz(kwargs['mute_alerts'], msg)
-        b['treatment'](b)
+        alert(msg, **kwargs)
+        treatment(b)
 
-def mind_resource(b, **kwargs):
+## BEGIN Check Plans ##
+def load_beeswax(path=None):
+    """Reads the list of checks (beeswax entries) from a JSON file or (if
+    PyYAML is installed) a YAML file, which defaults to the beeswax.json
+    next to this script."""
+    if path is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'beeswax.json')
+    with open(path, 'r') as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml # Only needed for YAML beeswax files.
+            beeswax = yaml.safe_load(f)
+        else:
+            beeswax = json.load(f)
+    if not isinstance(beeswax, list) or not all(isinstance(b, dict) for b in beeswax):
+        raise ValueError("{} should contain a list of beeswax entries.".format(path))
+    return beeswax
+
+# The parameters that each assertion (or post-loop assertion) needs from
+# its beeswax entry.
+assertion_parameters = {
+    'int': [],
+    'contains_values': ['source_field_name', 'reference'],
+    'regex': ['pattern'],
+    'range': [],
+    'null_rate': [],
+    'profile': ['thresholds'],
+    }
+post_loop_assertion_parameters = {
+    'leftover_references': [],
+    'max_null_rate': ['max_null_rate'],
+    'profile_thresholds': ['thresholds'],
+    }
+
+def validate_check(b):
+    # Returns a list of the problems with the beeswax entry b.
+    problems = []
+    for parameter in ['name', 'field_name', 'assertion']:
+        if parameter not in b:
+            problems.append("'{}' is missing.".format(parameter))
+    if ('resource_id' in b) == ('package_id' in b):
+        problems.append("Exactly one of 'resource_id' and 'package_id' is needed.")
+    assertion = b.get('assertion')
+    if assertion is not None and assertion not in assertion_parameters:
+        problems.append("Unknown assertion '{}'.".format(assertion))
+    post_loop_assertion = b.get('post-loop_assertion')
+    if post_loop_assertion is not None and post_loop_assertion not in post_loop_assertion_parameters:
+        problems.append("Unknown post-loop assertion '{}'.".format(post_loop_assertion))
+    needed = assertion_parameters.get(assertion, []) + post_loop_assertion_parameters.get(post_loop_assertion, [])
+    problems += ["The '{}' parameter is missing.".format(parameter) for parameter in needed if parameter not in b]
+    if assertion == 'range' and b.get('min') is None and b.get('max') is None:
+        problems.append("A 'range' assertion needs a 'min' or a 'max'.")
+    # Some assertions only gather what their post-loop assertion judges, so
+    # each needs the other.
+    for paired_assertion, paired_post_loop_assertion in [('null_rate', 'max_null_rate'), ('profile', 'profile_thresholds')]:
+        if assertion == paired_assertion and post_loop_assertion != paired_post_loop_assertion:
+            problems.append("A '{}' assertion needs '{}' as its post-loop assertion.".format(paired_assertion, paired_post_loop_assertion))
+        elif post_loop_assertion == paired_post_loop_assertion and assertion != paired_assertion:
+            problems.append("The '{}' post-loop assertion needs '{}' as its assertion.".format(paired_post_loop_assertion, paired_assertion))
+    if post_loop_assertion == 'leftover_references' and assertion != 'contains_values':
+        problems.append("The 'leftover_references' post-loop assertion needs 'contains_values' as its assertion.")
+    if isinstance(b.get('thresholds'), dict):
+        for name, bounds in b['thresholds'].items():
+            if not ColumnProfile.is_statistic(name):
+                problems.append("Unknown statistic '{}' in the thresholds.".format(name))
+            elif not isinstance(bounds, dict) or not bounds or set(bounds) - {'min', 'max'}:
+                problems.append("The threshold for '{}' should be like {{\"min\": ..., \"max\": ...}}.".format(name))
+    elif 'thresholds' in b:
+        problems.append("'thresholds' should map statistic names to bounds.")
+    choices = {'strategy': scan_strategies, 'paging': ['offset', 'keyset'], 'evaluation': ['server', 'client']}
+    for parameter, values in choices.items():
+        if parameter in b and b[parameter] not in values:
+            problems.append("'{}' should be one of {}, not '{}'.".format(parameter, ', '.join(values), b[parameter]))
+    if 'treatment' in b and not callable(b['treatment']) and b['treatment'] not in treatments:
+        problems.append("Unknown treatment '{}'.".format(b['treatment']))
+    if not problems:
+        try: # Building the assertion functions catches things like a bad regex.
+            batch_functionalize(b)
+            if post_loop_assertion is not None:
+                functionalize(post_loop_assertion, b)
+            if assertion == 'profile':
+                ColumnProfile(**b.get('sketch_options', {}))
+        except (ValueError, TypeError, re.error) as e:
+            problems.append("The assertion can't be set up: {}".format(e))
+    return problems
+
+def compile_plan(beeswax):
+    """Validates the beeswax entries and returns the plan for running them:
+    a copy of each entry with its assertion function already built (so
+    that, e.g., a regex is compiled once, before any data is fetched). If
+    anything is wrong, a ValueError lists every problem with every entry."""
+    problems = []
+    codes = Counter(b.get('code') for b in beeswax if b.get('code') is not None)
+    problems += ["The code '{}' is used by {} checks.".format(code, count) for code, count in codes.items() if count > 1]
+    plan = []
+    for k, b in enumerate(beeswax):
+        check_problems = validate_check(b)
+        if check_problems:
+            label = b.get('code') or b.get('name') or "Check #{}".format(k + 1)
+            problems += ["{}: {}".format(label, problem) for problem in check_problems]
+            continue
+        entry = dict(b)
+        entry['assertion_function'] = batch_functionalize(b)
+        plan.append(entry)
+    if problems:
+        raise ValueError("Problems were found in the beeswax:\n" + '\n'.join('    ' + problem for problem in problems))
+    return plan
+## END Check Plans ##
+
+def prepare_resource_check(b, **kwargs):
+    # The part of mind_resource that comes before the scan of the datastore.
+    # Returns a status if the check is already settled (like if the resource
+    # is private or hasn't changed), or else a dict of what the scan needs
+    # (or, under 'everything_is_fine', the result, if the datastore itself
+    # was able to evaluate the assertion).
     from credentials import site, ckan_api_key as API_key
-    if resource_is_private(site, b['resource_id'], API_key):
+    from ckan_util import get_ckan, resource_is_private, get_resource_metadata
+    ckan = kwargs.get('ckan') or get_ckan(site, API_key)
+    if resource_is_private(site, b['resource_id'], API_key, ckan):
         print("This resource is private, so the test can not be run.")
-        return
+        return 'skipped'
 
-    schema = get_schema(site, b['resource_id'], API_key=API_key)
+    schema = get_schema(site, b['resource_id'], API_key=API_key, ckan=ckan)
     field_names = [s['id'] for s in schema]
-    reference_values = []
+    if b['field_name'] not in field_names:
+        msg = "Unable to find field called '{}' in schema for resource with resource ID {}.".format(b['field_name'], b['resource_id'])
+        print(msg)
+        alert(msg, **kwargs)
+        return 'error'
+
+    assertion_function = b.get('assertion_function') or batch_functionalize(b)
+    # Compare the resource to what it looked like the last time it was scanned.
+    scan_state = kwargs.get('scan_state', {})
+    definition = check_definition(b)
+    previous = None
+    if kwargs.get('incremental', True) and b.get('incremental', True):
+        previous = scan_state.get(scan_state_key(b))
+    if previous is not None and previous.get('definition') != definition:
+        print("This check has been changed since the resource was last scanned, so that scan is being disregarded.")
+        previous = None
+    resume = previous.get('resume') if previous is not None else None
+    if previous is not None and previous.get('strategy', 'full') not in ['full', 'first_failures']:
+        previous = None # A pass on a sample of the rows doesn't vouch for the rest of them.
+    # A strategy given for the whole run (like 'sample' for hourly runs)
+    # takes precedence over the strategy of the beeswax entry.
+    strategy = kwargs.get('strategy') or b.get('strategy', 'full')
+    if strategy in ['sample', 'head_tail_sample'] and 'post-loop_assertion' in b:
+        print("The '{}' assertion needs to see every row, so a full scan will be run instead of '{}'.".format(b['assertion'], strategy))
+        strategy = 'full'
+    if strategy != 'full':
+        print("Scan strategy: {}".format(strategy))
+    resource_metadata = get_resource_metadata(b['resource_id'], ckan)
+    last_modified = resource_metadata.get('last_modified') or resource_metadata.get('metadata_modified')
+    row_count = get_number_of_rows(site, b['resource_id'], API_key, ckan)
+    progress = {}
+    # A post-loop assertion (like a check that every reference value is in
+    # the datastore) can fail without the datastore changing (like when the
+    # reference file gains values), so those checks are never skipped.
+    skippable = 'post-loop_assertion' not in b
+    # An ETL upsert can rewrite old rows without changing last_modified or
+    # the row count, so with 'fingerprints' on, the datastore hashes each
+    # range of _id values, and only the ranges whose hashes have changed
+    # since the last pass get checked again (see fingerprints.py).
+    fingerprints = None
+    if (kwargs.get('fingerprints') or b.get('fingerprints')) and strategy in ['full', 'first_failures']:
+        fingerprints = get_fingerprints(site, b['resource_id'], b['field_name'], b.get('fingerprint_range', 10000), API_key, ckan)
+    if fingerprints is not None and previous is not None:
+        from fingerprints import comparable, changed_leaves, leaf_ranges
+        if previous['result'] == 'pass' and comparable(previous.get('fingerprints'), fingerprints):
+            changed = changed_leaves(previous['fingerprints'], fingerprints)
+            if not changed and skippable:
+                print("The fingerprints of this resource haven't changed since it passed on {}, so it is not being scanned again.".format(previous['scanned_at']))
+                return 'unchanged'
+            print("{} of {} (of {} _id values each) have changed since the last pass.".format(len(changed),
+                pluralize('range', fingerprints['leaves']), fingerprints['range_size']))
+            # When most of the ranges have changed, walking them one at a
+            # time would cost more than just scanning every row.
+            if skippable and len(changed) <= b.get('max_changed_fraction', 0.5) * len(fingerprints['leaves']):
+                progress['ranges'] = leaf_ranges(changed, fingerprints['range_size'])
+        else:
+            print("There are no fingerprints from an earlier pass to compare to, so every row will be checked.")
+        previous = None # The fingerprints take the place of last_modified and the last _id.
+    if (skippable and previous is not None and previous['result'] == 'pass' and previous['last_modified'] == last_modified
+            and previous['row_count'] == row_count):
+        print("This resource hasn't changed since it passed on {}, so it is not being scanned again.".format(previous['scanned_at']))
+        return 'unchanged'
+
+    # (Only now that the check is going to run is any reference file fetched.)
+    reference_values = ReferenceValues()
     if b['assertion'] in ['contains_values']:
-        # Prepare reference values
+        # Prepare reference values in the background, while the datastore is being scanned:
         # 1) Get file from source and save to reference_files directory
-        local_filepath = fetch_data_file(b)
         # 2) Pull out reference values
-        reference_values = get_data_by_field(local_filepath, b['source_field_name'])
+        from fetch import fetch_data_file, get_data_by_field
+        count_duplicates = b.get('count_duplicates', False)
+        load_reference = lambda: get_data_by_field(fetch_data_file(b), b['source_field_name'], as_set=not count_duplicates)
+        reference_fetcher = ThreadPoolExecutor(max_workers=1)
+        reference_values = DeferredReferenceValues(reference_fetcher.submit(load_reference), count_duplicates=count_duplicates)
+        reference_fetcher.shutdown(wait=False)
+    elif b['assertion'] in ['null_rate']:
+        reference_values = Counter(nulls=0, values=0)
+    elif b['assertion'] in ['profile']:
+        reference_values = ColumnProfile(**b.get('sketch_options', {}))
 
-    assertion_function = functionalize(b['assertion'])
-    if b['field_name'] in field_names:
-        # Run assertion_function on all values in the field.
-        everything_is_fine = apply_function_to_all_records(site, b, b['resource_id'], b['field_name'], assertion_function, reference_values, API_key)
-        if everything_is_fine:
-            print("\nEverything is fine.")
-        else:
-            msg = " ** The assertion {} failed on field name '{}' for resource with ID {}. **".format(assertion_function, b['field_name'], b['resource_id'])
-            print(msg)
-            buzz(kwargs['mute_alerts'], msg)
-            apply_treatment(b, **kwargs)
+    if (skippable and previous is not None and previous['result'] == 'pass' and row_count > previous['row_count']
+            and count_rows_up_to(site, b['resource_id'], previous['last_id'], API_key, ckan) == previous['row_count']):
+        # Only the rows added since the last scan need to be checked, as
+        # long as rows were only added (the rows with _id values up to the
+        # last one checked are all still there, and no more). If anything
+        # else changed (like a reload with the same number of rows), every
+        # row is checked.
+        progress['last_id'] = previous['last_id']
+        print("This resource passed with {} on {}, so only rows with _id > {} will be checked.".format(pluralize('row', None, count=previous['row_count']),
+            previous['scanned_at'], previous['last_id']))
+    if (skippable and resume is not None and b.get('paging', 'offset') == 'keyset' and strategy in ['full', 'first_failures']
+            and 'ranges' not in progress and resume['last_modified'] == last_modified and resume['row_count'] == row_count
+            and resume['last_id'] > progress.get('last_id', 0)):
+        # The last scan failed partway through, and the resource hasn't
+        # changed since, so this one picks up where that one left off.
+        progress['last_id'] = resume['last_id']
+        print("The last scan of this resource failed on {} after checking the rows up to _id {}, so this scan will resume from there.".format(resume['failed_at'],
+            resume['last_id']))
+    # Rows added while the scan is running may or may not get checked, so
+    # the state records the highest _id from before the scan starts.
+    max_id = get_max_id(site, b['resource_id'], API_key, ckan)
+
+    everything_is_fine = None
+    if b.get('evaluation', 'server') == 'server' and b['assertion'] in sql_failure_conditions:
+        # Let the datastore find any rows that fail the assertion.
+        everything_is_fine = apply_assertion_on_server(site, b, b['resource_id'], b['field_name'], API_key, progress.get('last_id', 0), progress, ckan=ckan,
+                ranges=progress.get('ranges'))
+        if everything_is_fine is not None and strategy != 'first_failures':
+            strategy = 'full' # The datastore checked every row.
+    return {'assertion_function': assertion_function,
+            'reference_values': reference_values,
+            'strategy': strategy,
+            'progress': progress,
+            'last_modified': last_modified,
+            'row_count': row_count,
+            'max_id': max_id,
+            'fingerprints': fingerprints,
+            'everything_is_fine': everything_is_fine}
+
+def content_version(check):
+    # What a snapshot of the resource is keyed by: its last_modified
+    # timestamp, plus its fingerprints (if any), which also change when
+    # rows are rewritten in place.
+    if check.get('fingerprints') is not None:
+        return "{} {}".format(check['last_modified'], check['fingerprints']['root'])
+    return check['last_modified']
+
+def start_id_of(b, check):
+    # Where the scan for a prepared check starts (see apply_function_to_all_records).
+    return check['progress'].get('last_id', 0)
+
+def finish_resource_check(b, check, **kwargs):
+    # The part of mind_resource that comes after the scan: it reports the
+    # result, applies any treatment, and updates the scan state.
+    if check['everything_is_fine']:
+        print("\nEverything is fine.")
+        status = 'pass'
     else:
-        msg = "Unable to find field called '{}' in schema for resource with resource ID {}.".format(b['field_name'], b['resource_id'])
+        progress = check['progress']
+        msg = " ** The assertion '{}' failed on field name '{}' for resource with ID {}. **".format(b['assertion'], b['field_name'], b['resource_id'])
+        if len(progress.get('offending_rows', [])) > 0:
+            msg += "\nOffending rows:\n" + '\n'.join("    _id {}: {}".format(r['_id'], r['value']) for r in progress['offending_rows'])
         print(msg)
-        buzz(kwargs['mute_alerts'], msg)
+        alert(msg, **kwargs)
+        apply_treatment(b, **kwargs)
+        status = 'fail'
+    scan_state = kwargs.get('scan_state', {})
+    key = scan_state_key(b)
+    entry = {'resource_id': b['resource_id'],
+            'last_id': check['max_id'],
+            'row_count': check['row_count'],
+            'last_modified': check['last_modified'],
+            'result': status,
+            'strategy': check['strategy'],
+            'definition': check_definition(b),
+            'scanned_at': datetime.now().isoformat()}
+    if check.get('fingerprints') is not None:
+        entry['fingerprints'] = check['fingerprints']
+    previous = scan_state.get(key)
+    if (check['strategy'] not in ['full', 'first_failures'] and previous is not None and previous.get('strategy', 'full') in ['full', 'first_failures']
+            and previous.get('definition') == entry['definition']):
+        # A pass on a sample of the rows doesn't vouch for the rest of them,
+        # so the state of the last scan of every row is kept (for the next
+        # full scan to compare to), with the sample's result beside it.
+        previous['last_sample'] = entry
+    else:
+        scan_state[key] = entry
+    return status
+
+def record_interrupted_scan(b, check, **kwargs):
+    # When a keyset scan of every row fails partway through (like when the
+    # datastore keeps timing out), the _id up to which every row was
+    # checked (and passed) is stored in the scan state, so that the next
+    # run can pick up from there (see prepare_resource_check) instead of
+    # starting over.
+    progress = check['progress']
+    if (b.get('paging', 'offset') != 'keyset' or 'last_id' not in progress or 'ranges' in progress
+            or 'post-loop_assertion' in b or check['strategy'] not in ['full', 'first_failures']):
+        return
+    scan_state = kwargs.get('scan_state', {})
+    key = scan_state_key(b)
+    definition = check_definition(b)
+    if scan_state.get(key, {}).get('definition') != definition:
+        scan_state[key] = {'resource_id': b['resource_id'], 'result': 'error', 'strategy': check['strategy'], 'definition': definition}
+    entry = scan_state[key]
+    entry['resume'] = {'last_id': progress['last_id'],
+            'row_count': check['row_count'],
+            'last_modified': check['last_modified'],
+            'failed_at': datetime.now().isoformat()}
+
+def mind_resource(b, **kwargs):
+    from credentials import site, ckan_api_key as API_key
+    check = prepare_resource_check(b, **kwargs)
+    if not isinstance(check, dict):
+        return check
+    if check['everything_is_fine'] is None:
+        # Run assertion_function on all values in the field.
+        try:
+            check['everything_is_fine'] = apply_function_to_all_records(site, b, b['resource_id'], b['field_name'], check['assertion_function'],
+                    check['reference_values'], API_key, progress=check['progress'], strategy=check['strategy'], ckan=kwargs.get('ckan'),
+                    snapshots=kwargs.get('snapshots'), last_modified=content_version(check))
+        except Exception:
+            record_interrupted_scan(b, check, **kwargs)
+            raise
+    return finish_resource_check(b, check, **kwargs)
 
 def mind_package(b, **kwargs):
     # Currently this function just applies the assertion to
@@ -285,144 +1236,490 @@ def mind_package(b, **kwargs):
     # so an assertion type or assertion target might be a useful
     # way of representing that.
     from credentials import site, ckan_api_key as API_key
-    if package_is_private(site, b['package_id'], API_key):
+    from ckan_util import get_ckan, package_is_private, get_all_resources
+    ckan = kwargs.get('ckan') or get_ckan(site, API_key)
+    if package_is_private(site, b['package_id'], API_key, ckan):
         print("This package is private, so the test can not be run.")
-        return
-    # Get all resources in package
-    resources = get_all_resources(b['package_id'])
+        return 'skipped'
+    # Get all resources in package. Whether each one has an active datastore
+    # is already in the package_show results, so no resource_show calls are
+    # needed.
+    resources = get_all_resources(b['package_id'], ckan)
+    datastore_resources = [r for r in resources if r.get('datastore_active', False)]
+    if len(datastore_resources) == 0:
+        print("This package has no resources with active datastores.")
+        return 'skipped'
 
-    for resource_id in resource_ids:
-        if has_public_datastore(resource_id):
-            b_resource = dict(b)
-            b_resource['resource_id'] = resource_id
-            mind_resource(b_resource, **kwargs)
+    check_metrics = metrics.current()
 
-def mind_beeswax(beeswax, **kwargs):
-    if 'selected_codes' in kwargs:
-        beeswax = [w for w in beeswax if w.get('code', 'NO CODE') in kwargs['selected_codes']]
-        print(f"Selecting codes {kwargs['selected_codes']}")
-    for b in beeswax:
+    def mind_package_resource(resource):
+        check_metrics.activate() # The resources' calls count toward the package check's metrics.
+        b_resource = dict(b)
+        b_resource['resource_id'] = resource['id']
+        # When the output of the check is being captured, each resource's
+        # output is captured separately and printed in order afterward.
+        output = sys.stdout
+        capturing = isinstance(output, CheckOutput)
+        if capturing:
+            output.capture()
+        try:
+            status = mind_resource(b_resource, **kwargs)
+        except Exception:
+            status = 'error'
+            msg = "The check '{}' failed for some reason on resource {} ({}).\n".format(b['name'], resource.get('name', ''), resource['id']) + format_exception()
+            print(msg)
+            alert(msg, **kwargs)
+        finally:
+            text = output.release() if capturing else ''
+        return status, text
+
+    # The resources (like the yearly resources of a package) are scanned
+    # concurrently.
+    with ThreadPoolExecutor(max_workers=max(1, b.get('parallel_resources', 4))) as executor:
+        outcomes = list(executor.map(mind_package_resource, datastore_resources))
+
+    statuses = []
+    for resource, (status, text) in zip(datastore_resources, outcomes):
+        print(" --- {} ({}) --- ".format(resource.get('name', ''), resource['id']))
+        print(text, end='')
+        statuses.append(status)
+    print("Results for {}:".format(pluralize('resource', statuses)))
+    for resource, status in zip(datastore_resources, statuses):
+        print("    {:<9} {} ({})".format(str(status), resource.get('name', ''), resource['id']))
+    for overall in ['error', 'fail', 'pass', 'unchanged']:
+        if overall in statuses:
+            return overall
+    return 'skipped'
+
+class CheckOutput():
+    """Stands in for sys.stdout while checks run in parallel. Whatever a
+    thread prints after calling capture() goes into that thread's own
+    buffer (which release() returns), so the output of each check can be
+    printed as one block instead of being interleaved with the others."""
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def capture(self):
+        self.local.buffer = io.StringIO()
+
+    def release(self):
+        text = self.local.buffer.getvalue()
+        del self.local.buffer
+        return text
+
+    def redirect(self, buffer):
+        # Sends what this thread prints to the given buffer (or, if it's
+        # None, straight to the stream), returning the buffer it replaces.
+        previous = getattr(self.local, 'buffer', None)
+        self.local.buffer = buffer
+        return previous
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+def run_check(b, output, **kwargs):
+    output.capture()
+    alerts = []
+    check_metrics = CheckMetrics(b.get('code', None), b['name'])
+    check_metrics.activate()
+    try:
         print(" === {} === ".format(b['name']))
         if 'resource_id' in b:
-            mind_resource(b, **kwargs)
+            status = mind_resource(b, alerts=alerts, **kwargs)
         elif 'package_id' in b:
-            mind_package(b, **kwargs)
+            status = mind_package(b, alerts=alerts, **kwargs)
         else:
             raise ValueError("mind_beeswax does not know how to handle this task: {}".format(b))
+    except Exception:
+        status = 'error'
+        msg = "The check '{}' failed for some reason.\n".format(b['name']) + format_exception()
+        print(msg)
+        alerts.append(msg)
+    finally:
+        text = output.release()
+        check_metrics.finish(status)
+        metrics.local.metrics = None
+    if alerts:
+        buzz(kwargs['mute_alerts'], '\n'.join(alerts))
+    result = check_metrics.summary()
+    result['output'] = text
+    return result
+
+@contextmanager
+def working_on(run, output):
+    # While working on one of the checks in a group (see run_check_group),
+    # what is printed goes to that check's output and what is done counts
+    # toward that check's metrics.
+    previous_buffer = output.redirect(run['buffer'])
+    previous_metrics = getattr(metrics.local, 'metrics', None)
+    run['metrics'].activate()
+    try:
+        yield
+    finally:
+        output.redirect(previous_buffer)
+        metrics.local.metrics = previous_metrics
 
+def run_check_group(bs, output, **kwargs):
+    # Runs several checks of the same resource (which may look at different
+    # fields with different assertions) with as few scans of the resource as
+    # possible: each check is prepared in turn, the checks that need a scan
+    # (with the same strategy and paging mode) share one that fetches the
+    # union of their fields, and then each check reports its result. The
+    # shared scan is fetched with the settings of its first check, and the
+    # fetching counts toward that check's metrics and output, but the
+    # results, output, alerts, and metrics are otherwise kept separate, as
+    # if each check had been run by run_check.
+    from credentials import site, ckan_api_key as API_key
+    runs = [{'b': b, 'buffer': io.StringIO(), 'alerts': [], 'metrics': CheckMetrics(b.get('code', None), b['name']),
+        'status': None, 'check': None} for b in bs]
+
+    def settle(run, step):
+        # Runs one step of a check, which ends the check with an 'error'
+        # status if anything goes wrong.
+        with working_on(run, output):
+            try:
+                return step()
+            except Exception:
+                run['status'] = 'error'
+                msg = "The check '{}' failed for some reason.\n".format(run['b']['name']) + format_exception()
+                print(msg)
+                run['alerts'].append(msg)
+
+    for run in runs:
+        def prepare():
+            print(" === {} === ".format(run['b']['name']))
+            return prepare_resource_check(run['b'], alerts=run['alerts'], **kwargs)
+        check = settle(run, prepare)
+        if isinstance(check, dict):
+            run['check'] = check
+        elif run['status'] is None:
+            run['status'] = check
+
+    shared_scans = {}
+    for run in runs:
+        if run['status'] is None and run['check']['everything_is_fine'] is None:
+            ranges = run['check']['progress'].get('ranges')
+            key = (run['check']['strategy'], run['b'].get('paging', 'offset'), tuple(ranges) if ranges else None)
+            shared_scans.setdefault(key, []).append(run)
+    for (strategy, paging, ranges), members in shared_scans.items():
+        owner = members[0]
+        scans = [AssertionScan(m['b'], m['b']['field_name'], m['check']['assertion_function'], m['check']['reference_values'],
+            m['check']['progress'], strategy, start_id_of(m['b'], m['check']), m['metrics'], context=lambda m=m: working_on(m, output))
+            for m in members]
+        for m in members[1:]:
+            with working_on(m, output):
+                print("This check is sharing a scan of the resource with '{}'.".format(owner['b'].get('code', owner['b']['name'])))
+        with working_on(owner, output):
+            try:
+                outcomes = apply_assertion_scans(site, owner['b'], owner['b']['resource_id'], scans, API_key, strategy=strategy, ckan=kwargs.get('ckan'),
+                        snapshots=kwargs.get('snapshots'), last_modified=content_version(owner['check']), ranges=list(ranges) if ranges else None)
+            except Exception as e:
+                outcomes = [e for m in members]
+        for m, outcome in zip(members, outcomes):
+            m['check']['everything_is_fine'] = outcome
+
+    results = []
+    for run in runs:
+        if run['status'] is None:
+            def finish():
+                if isinstance(run['check']['everything_is_fine'], Exception):
+                    record_interrupted_scan(run['b'], run['check'], **kwargs)
+                    raise run['check']['everything_is_fine']
+                return finish_resource_check(run['b'], run['check'], alerts=run['alerts'], **kwargs)
+            status = settle(run, finish)
+            if run['status'] is None:
+                run['status'] = status
+        run['metrics'].finish(run['status'])
+        if run['alerts']:
+            buzz(kwargs['mute_alerts'], '\n'.join(run['alerts']))
+        result = run['metrics'].summary()
+        result['output'] = run['buffer'].getvalue()
+        results.append(result)
+    return results
+
+def group_checks(beeswax):
+    # Groups the checks of each resource together, so that the resource
+    # only has to be scanned once for all of them (see run_check_group).
+    # Package-level checks, and checks with 'shared_scan' set to False, are
+    # each in a group of their own.
+    groups = {}
+    for k, b in enumerate(beeswax):
+        if 'resource_id' in b and b.get('shared_scan', True):
+            groups.setdefault(('resource', b['resource_id']), []).append(b)
+        else:
+            groups[('check', k)] = [b]
+    return list(groups.values())
+
+def print_summary(results):
+    print(" === Summary === ")
+    width = max([len(r['code'] or r['name']) for r in results] + [5])
+    print("{:<{}}  {:<9}  {:>9}  {:>10}".format('check', width, 'status', 'seconds', 'rows/s'))
+    for r in results:
+        print("{:<{}}  {:<9}  {:>9.1f}  {:>10.0f}".format(r['code'] or r['name'], width, str(r['status']), r['seconds'], r['rows_per_second'] or 0))
+
+def store_run_report(results, started_at):
+    # Save the metrics of every check as run_report.json (and as a Prometheus
+    # textfile, beekeeper.prom) next to last_scan.json.
+    summaries = [{k: v for k, v in r.items() if k != 'output'} for r in results]
+    report = {'started_at': started_at.isoformat(),
+            'finished_at': datetime.now().isoformat(),
+            'seconds': (datetime.now() - started_at).total_seconds(),
+            'checks': summaries}
+    archive_directory = os.path.dirname(get_archive_path())
+    with open(os.path.join(archive_directory, 'run_report.json'), 'w') as f:
+        json.dump(report, f, ensure_ascii=True, indent = 4)
+    with open(os.path.join(archive_directory, 'beekeeper.prom'), 'w') as f:
+        f.write(prometheus_text(summaries))
+
+def mind_beeswax(beeswax, **kwargs):
+    if 'selected_codes' in kwargs:
+        beeswax = [w for w in beeswax if w.get('code', 'NO CODE') in kwargs['selected_codes']]
+        print(f"Selecting codes {kwargs['selected_codes']}")
+    beeswax = compile_plan(beeswax) # Find any problems before anything is run.
+    # All the checks share one pooled CKAN client, which also caps the
+    # number of CKAN requests in flight across all the checks.
+    if 'ckan' not in kwargs:
+        from credentials import site, ckan_api_key as API_key
+        from ckan_util import get_ckan
+        kwargs['ckan'] = get_ckan(site, API_key, max_in_flight=kwargs.get('max_in_flight', 8))
+    # What was found on the last run (saved in last_scan.json) lets checks skip
+    # resources that haven't changed since they passed and check only the rows
+    # that have been added since then. (Pass 'incremental=False' to check
+    # everything anyway.)
+    save_scan_state = 'scan_state' not in kwargs
+    if save_scan_state:
+        kwargs['scan_state'] = load_scan_state()
+    # With 'snapshot_directory' set, the columns fetched by full scans are
+    # kept on disk, and scans of resources that haven't changed since then
+    # read them from there (see SnapshotCache).
+    if kwargs.get('snapshot_directory') and 'snapshots' not in kwargs:
+        from snapshots import SnapshotCache
+        kwargs['snapshots'] = SnapshotCache(kwargs['snapshot_directory'], kwargs.get('snapshot_max_bytes', 2*1024**3))
+
+    # The checks of different resources don't depend on each other, so up
+    # to parallel_checks of them are run at once, and the run takes about as
+    # long as the check of the largest resource rather than the sum of all
+    # of them. (The checks of the same resource are run together, so that
+    # they can share a scan.)
+    # The output of each check is printed (and its alerts are sent) as a
+    # block when that check finishes.
+    results = []
+    started_at = datetime.now()
+    output = CheckOutput(sys.stdout)
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, kwargs.get('parallel_checks', 4))) as executor:
+            futures = [executor.submit(run_check, group[0], output, **kwargs) if len(group) == 1
+                    else executor.submit(run_check_group, group, output, **kwargs) for group in group_checks(beeswax)]
+            for future in as_completed(futures):
+                group_results = future.result()
+                for result in (group_results if isinstance(group_results, list) else [group_results]):
+                    output.stream.write(result['output'])
+                    results.append(result)
+                output.stream.flush()
+    finally:
+        sys.stdout = output.stream
+        notifications.flush() # Send whatever alerts are still waiting.
+        if 'fetch' in sys.modules: # Only if any reference files were fetched.
+            sys.modules['fetch'].close_sources()
+        if save_scan_state:
+            store_as_json(kwargs['scan_state'])
+            store_run_report(results, started_at)
+    print_summary(results)
+    return results
+
+
+def sweep_catalog(**kwargs):
+    # Finds the packages across the whole catalog that haven't been updated
+    # on their self-identified schedule (their frequency_publishing or
+    # frequency_data_change), from a few bulk package_search requests
+    # (sweep_rows packages at a time) rather than a package_show call per
+    # package, and sends the list as a single digest.
+    # 'grace' is how far past its period a package can go (as a fraction of
+    # the period) before it counts as overdue, and 'fq' can limit the sweep
+    # (like to "organization:city-of-pittsburgh").
+    from credentials import site, ckan_api_key as API_key
+    from ckan_util import get_ckan
+    from staleness import search_packages, overdue_packages, staleness_digest, sweep_fields
+    ckan = kwargs.get('ckan') or get_ckan(site, API_key)
+    start = time.perf_counter()
+    packages = list(search_packages(ckan, kwargs.get('sweep_rows', 1000), kwargs.get('fq'),
+        kwargs.get('include_private', False), sweep_fields))
+    overdue = overdue_packages(packages, grace=kwargs.get('grace', 0.5))
+    print("Swept {} in {:.1f} seconds.".format(pluralize('package', packages), time.perf_counter() - start))
+    if overdue:
+        digest = staleness_digest(overdue, site, len(packages))
+        print(digest)
+        buzz(kwargs['mute_alerts'], digest)
+        notifications.flush()
+    else:
+        print("No packages are overdue.")
+    return overdue
 
 #mind_resource(resource_id="37b11f07-361f-442a-966e-fbdc5eef0840", field_name="OwnerZip", assertion_function=functionalize("int"), mute_alerts=True)
 #        "128b3ad6-5b2e-4112-bef1-08154190ad01" Resource ID of a private test version of Geocoded Food Facilities. Guess what?
 # datastore_info doesn't work on private datasets because private datasets don't have queryable datastores.
 
 
-# Potential ways to specify checks:
-
-#1) Hard-code a list of beeswax dicts.
-beeswax = [
-#    { # This is no longer needed now that the right-of-way permits have
-# been moved to Google Cloud Platform and the ETL job is entirely different.
-#    'code': 'right_of_way_completeness',
-#    'name': "Right-of-Way Permits completeness checker",
-#    'resource_id': "cc17ee69-b4c8-4b0c-8059-23af341c9214",
-#    'field_name': "id",
-#    'source_field_name': "display", # We need to explicitly specify
-#    # the field name of the field in the source file to get the reference
-#    # values from, since the source and CKAN field names may differ.
-#    'assertion': 'contains_values',
-#    'post-loop_assertion': 'leftover_references',
-#    'reference':
-#        {
-#            'publisher': 'pgh',
-#            'type': 'ftp',
-#            #'directory': '/', # It's actually in the /pitt directory,
-#            # but that's already built into the expectations of the
-#            # FTP function.
-#            'file': 'right_of_way_permits.csv',
-#        },
-#    'target': 'datastore', # Could also be, for instance, 'metadata'.
-#    },
-    {
-    'code': 'dog_license_zip_code_2019',
-    'name': "Dog License ZIP-code checker (2019)",
-    'resource_id': "37b11f07-361f-442a-966e-fbdc5eef0840",
-    'field_name': "OwnerZip",
-    'assertion': 'int',
-    'target': 'datastore', # Could also be, for instance, 'metadata'.
-    'treatment': make_package_private, # Function to run if the assertion is violated.
-    },
-    {
-    'code': 'dog_license_zip_code_2020',
-    'name': "Dog License ZIP-code checker (2020)",
-    'resource_id': "75e867fe-3154-4be8-a7f3-5909653e5c06",
-    'field_name': "OwnerZip",
-    'assertion': 'int',
-    'target': 'datastore', # Could also be, for instance, 'metadata'.
-    'treatment': make_package_private, # Function to run if the assertion is violated.
-    },
-    {
-    'code': 'dog_license_zip_code_lifetime',
-    'name': "Dog License ZIP-code checker (Lifetime Dog License)",
-    'resource_id': "f8ab32f7-44c7-43ca-98bf-c1b444724598",
-    'field_name': "OwnerZip",
-    'assertion': 'int',
-    'target': 'datastore', # Could also be, for instance, 'metadata'.
-    'treatment': make_package_private, # Function to run if the assertion is violated.
-    },
-    ]
-
-# A beeswax dict can specify a resource ID (to run the test just on
+# The checks are specified in beeswax.json (or another JSON or YAML file
+# given on the command line), as a list of beeswax entries like this:
+#    {
+#        "code": "dog_license_zip_code_2019",
+#        "name": "Dog License ZIP-code checker (2019)",
+#        "resource_id": "37b11f07-361f-442a-966e-fbdc5eef0840",
+#        "field_name": "OwnerZip",
+#        "assertion": "int",
+#        "target": "datastore",
+#        "treatment": "make_package_private"
+#    }
+# A beeswax entry can specify a resource ID (to run the test just on
 # that resource) or a package ID (to run the test on all resources
-# in the package.
-
-# 2) Have a beeswax.json version of the hard-coded beeswax list.
-#       Here the functionalize function is used so that 'assertion'
-#       can just be a string and functionalize can assign the
-#       actual function, but that still means that a new check
-#       could require the modification of the functionalize
-#       function.
+# in the package). The treatment (run if the assertion is violated) is
+# named, and the name is looked up in the treatments registry.
+#
+# A completeness check compares a field to the values in a reference file:
+#    {
+#        "code": "right_of_way_completeness",
+#        "name": "Right-of-Way Permits completeness checker",
+#        "resource_id": "cc17ee69-b4c8-4b0c-8059-23af341c9214",
+#        "field_name": "id",
+#        "source_field_name": "display",
+#        "assertion": "contains_values",
+#        "post-loop_assertion": "leftover_references",
+#        "reference": {"publisher": "pgh", "type": "ftp", "file": "right_of_way_permits.csv"}
+#    }
+# (source_field_name needs to be given explicitly, since the source and
+# CKAN field names may differ.)
+#
+# A profiling check gathers statistics of a field in a single pass (with
+# streaming sketches, so memory use doesn't grow with the number of rows)
+# and fails if any of them drifts out of its bounds:
+#    {
+#        "code": "dog_license_zip_code_profile",
+#        "name": "Dog License ZIP-code profile",
+#        "resource_id": "37b11f07-361f-442a-966e-fbdc5eef0840",
+#        "field_name": "OwnerZip",
+#        "assertion": "profile",
+#        "post-loop_assertion": "profile_thresholds",
+#        "thresholds": {"null_rate": {"max": 0.01}, "distinct": {"min": 50, "max": 500},
+#            "top_share": {"max": 0.2}, "numeric_rate": {"min": 0.99}, "p50": {"min": 15000, "max": 15300}}
+#    }
+# The statistics are count, nulls, null_rate, distinct (estimated with a
+# HyperLogLog), distinct_ratio, numeric_rate, min, max, mean, top_share
+# (the share of the most frequent value), and percentiles like p50 or
+# p99.9 (estimated with a t-digest); see sketches.py. The sizes of the
+# sketches can be set with "sketch_options", like {"precision": 12,
+# "top_k": 50, "compression": 200}.
+#
+# With "fingerprints": true (or the 'fingerprints' option), a check that
+# has passed is only rerun on the ranges of "fingerprint_range" (10000 by
+# default) _id values whose values the datastore hashes differently than
+# it did at the last pass, which catches old rows rewritten in place. If
+# more than "max_changed_fraction" (0.5 by default) of the ranges have
+# changed, every row is checked instead.
 
-# 3) It would be nice to have a mode where a check could be specified
+# It would be nice to have a mode where a check could be specified
 # from the command-line, like
 # > python beekeeper.py mind_resource --resource_id=37b11f07-361f-442a-966e-fbdc5eef0840 --field_name=OwnerZip --assertion=int
-# This should be possible using Google Fire, but it'll take some work to get Google Fire and this script's command-line
-# parsing to work together.
 
-from credentials import production
+usage = """Usage: python beekeeper.py [beeswax file] [options] [check codes]
+
+Runs the checks in beeswax.json (or the given .json/.yaml/.yml file), or
+just the ones with the given codes.
+
+Commands:
+    list              List the codes and names of the checks.
+    validate          Check the beeswax file for problems without running anything.
+    sweep             List the packages in the whole catalog that are overdue
+                      for an update (by their publishing frequency).
+    help              Show this message.
+
+Options:
+    mute              Don't send alerts to Slack.
+    test, production  Set the mode.
+    full              Check every row, ignoring what the last scan found.
+    fingerprints      Have the datastore hash each range of rows, and check
+                      only the ranges that changed since the last pass.
+    snapshots         Keep the columns that full scans fetch in snapshots/,
+                      and read unchanged resources from there.
+    sample, head_tail_sample, first_failures
+                      Use this scan strategy for every check."""
 
-beeswax_codes = [w.get('code', None) for w in beeswax]
+production = False
+kwargs = {}
 try:
     if __name__ == '__main__':
-        kwargs = {}
-        kwargs['mute_alerts'] = not production
-        check_private_datasets = False
-        kwargs['test_mode'] = False
         args = sys.argv[1:]
-        copy_of_args = list(args)
-        selected_codes = []
-        for k,arg in enumerate(copy_of_args):
-            if arg in ['mute', 'mute_alerts']:
-                kwargs['mute_alerts'] = True
-                args.remove(arg)
-            elif arg in ['test']:
-                kwargs['test_mode'] = True
-                args.remove(arg)
-            elif arg in ['production']:
-                kwargs['test_mode'] = False
-                args.remove(arg)
-            #elif arg in ['private']: # This won't work.
-            #    check_private_datasets = True
-            #    args.remove(arg)
-            elif arg in beeswax_codes:
-                selected_codes.append(arg)
+        beeswax_path = None
+        for arg in list(args):
+            if arg.endswith(('.json', '.yaml', '.yml')):
+                beeswax_path = arg
                 args.remove(arg)
 
-        if selected_codes != []:
-            kwargs['selected_codes'] = selected_codes
-        if len(args) > 0:
-            print("Unused command-line arguments: {}".format(args))
+        if set(args) & {'help', '-h', '--help'}:
+            print(usage)
+        elif 'list' in args:
+            for b in load_beeswax(beeswax_path):
+                print("{:<40}  {}".format(b.get('code', 'NO CODE'), b.get('name', '')))
+        elif 'validate' in args:
+            plan = compile_plan(load_beeswax(beeswax_path))
+            print("All {} look fine.".format(pluralize('check', plan)))
+        elif 'sweep' in args:
+            from credentials import production
+            kwargs['mute_alerts'] = not production or 'mute' in args
+            sweep_catalog(**kwargs)
+        else:
+            from credentials import production
+            kwargs['mute_alerts'] = not production # (Set before anything can fail, for the error handler below.)
+            beeswax = load_beeswax(beeswax_path)
+            beeswax_codes = [w.get('code', None) for w in beeswax]
+            check_private_datasets = False
+            kwargs['test_mode'] = False
+            copy_of_args = list(args)
+            selected_codes = []
+            for k,arg in enumerate(copy_of_args):
+                if arg in ['mute', 'mute_alerts']:
+                    kwargs['mute_alerts'] = True
+                    args.remove(arg)
+                elif arg in ['test']:
+                    kwargs['test_mode'] = True
+                    args.remove(arg)
+                elif arg in ['production']:
+                    kwargs['test_mode'] = False
+                    args.remove(arg)
+                elif arg in ['full']: # Rescan everything, ignoring the last scan.
+                    kwargs['incremental'] = False
+                    args.remove(arg)
+                elif arg in ['fingerprints']: # Recheck only the ranges of rows that changed.
+                    kwargs['fingerprints'] = True
+                    args.remove(arg)
+                elif arg in ['snapshots']: # Cache the scanned columns on disk.
+                    kwargs['snapshot_directory'] = os.path.join(os.path.dirname(get_archive_path()), 'snapshots')
+                    args.remove(arg)
+                elif arg in scan_strategies: # Use this scan strategy for every check.
+                    kwargs['strategy'] = arg
+                    args.remove(arg)
+                #elif arg in ['private']: # This won't work.
+                #    check_private_datasets = True
+                #    args.remove(arg)
+                elif arg in beeswax_codes:
+                    selected_codes.append(arg)
+                    args.remove(arg)
+
+            if selected_codes != []:
+                kwargs['selected_codes'] = selected_codes
+            if len(args) > 0:
+                print("Unused command-line arguments: {}".format(args))
 
-        mind_beeswax(beeswax, **kwargs)
+            mind_beeswax(beeswax, **kwargs)
 
 except:
     e = sys.exc_info()[0]
@@ -433,4 +1730,5 @@ except:
     msg = "beekeeper/beekeeper.py failed for some reason.\n" + msg
     print(msg) # Log it or whatever here
     if production:
-        buzz(kwargs['mute_alerts'], msg, username='beekeeper', channel='@david', icon=':illuminati:')
+        buzz(kwargs.get('mute_alerts', False), msg, username='beekeeper', channel='@david', icon=':illuminati:')
+        notifications.flush()
@@ -0,0 +1,271 @@
+# This script benchmarks beekeeper's scans against a local stand-in for
+# the CKAN action API, so that the throughput of different versions can be
+# compared without a network (or any risk of hammering a real CKAN instance).
+
+# Usage:
+# python benchmark.py
+# python benchmark.py --rows=[10000,10000000] --latency=0.02 --offset_latency=1e-7 --error_rate=0.01
+# python benchmark.py --paging=keyset --strategy=sample --output=benchmark_results.json
+
+import sys, re, json, time, types, random, resource, subprocess, multiprocessing, fire
+
+from concurrent.futures import ProcessPoolExecutor
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+BREEDS = ['LABRADOR RETRIEVER', 'BEAGLE', 'GERMAN SHEPHERD', 'CHIHUAHUA', 'PIT BULL', 'MIXED']
+COLORS = ['BLACK', 'BROWN', 'WHITE', 'TAN', 'BRINDLE']
+SCHEMA = {'OwnerZip': 'text', 'Breed': 'text', 'Color': 'text', 'DogName': 'text', 'ExpYear': 'text'}
+
+def is_bad_row(_id, bad_rate):
+    # A multiplicative hash picks out the same bad_rate fraction of the
+    # rows every time, without having to store anything.
+    return bad_rate > 0 and ((_id * 2654435761) % 2**32) / 2**32 < bad_rate
+
+def synthetic_record(_id, bad_rate=0.0):
+    # The values in a row are a function of its _id, so any page of a
+    # resource can be generated on demand, however many rows it has.
+    return {'_id': _id,
+            'OwnerZip': 'PA {}'.format(15200 + _id % 37) if is_bad_row(_id, bad_rate) else str(15200 + _id % 37),
+            'Breed': BREEDS[_id % len(BREEDS)],
+            'Color': COLORS[_id % len(COLORS)],
+            'DogName': 'DOG {}'.format(_id),
+            'ExpYear': str(2019 + _id % 3)}
+
+class FakeCKANHandler(BaseHTTPRequestHandler):
+    """Answers the CKAN actions that beekeeper uses (package_show,
+    resource_show, datastore_info, datastore_search, and the keyset-paging
+    query of datastore_search_sql) for the synthetic resources in the
+    server's config (along with the row-counting query that incremental
+    scans use). Each datastore request is delayed by the configured
+    latency plus offset_latency seconds per row skipped by its OFFSET (to
+    mimic Postgres walking past those rows), error_rate of them fail with a
+    500 error, and throttle_rate of them get a 429 response with a
+    Retry-After header. No request gets more than max_limit rows (like
+    CKAN's ckan.datastore.search.rows_max)."""
+    protocol_version = 'HTTP/1.1' # Keep connections alive, like a real server.
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body, headers=None):
+        out = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(out)
+
+    def error(self, status, error_type, message, headers=None):
+        self.respond(status, {'success': False, 'error': {'__type': error_type, 'message': message}}, headers)
+
+    def do_GET(self):
+        self.do_POST()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        data_dict = json.loads(self.rfile.read(length) or b'{}')
+        action = self.path.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+        config = self.server.config
+        resources = config['resources']
+        if action == 'package_show':
+            if data_dict.get('id') != config['package_id']:
+                return self.error(404, 'Not Found Error', 'Not found')
+            return self.respond(200, {'success': True, 'result': {'id': config['package_id'], 'private': False,
+                'resources': [self.resource_metadata(r) for r in resources]}})
+        if action == 'datastore_search_sql':
+            count_match = re.search(r'^SELECT COUNT\(\*\) AS "count" FROM "([^"]+)" WHERE "_id" <= (\d+)$', data_dict.get('sql', ''))
+            if count_match is not None and count_match.group(1) in resources:
+                count = min(int(count_match.group(2)), resources[count_match.group(1)])
+                return self.respond(200, {'success': True, 'result': {'records': [{'count': count}]}})
+            match = re.search(r'FROM "([^"]+)" WHERE "_id" > (\d+)(?: AND "_id" <= (\d+))? ORDER BY "_id" LIMIT (\d+)$', data_dict.get('sql', ''))
+            if match is None or match.group(1) not in resources:
+                # Only the keyset-paging query is understood. Anything else
+                # gets the response of a CKAN instance with
+                # datastore_search_sql turned off.
+                return self.error(403, 'Authorization Error', 'Access denied')
+            resource_id, last_id, limit = match.group(1), int(match.group(2)), int(match.group(4))
+            up_to_id = int(match.group(3)) if match.group(3) else None
+        else:
+            resource_id = data_dict.get('resource_id', data_dict.get('id'))
+            if resource_id not in resources:
+                return self.error(404, 'Not Found Error', 'Not found')
+        rows = resources[resource_id]
+        if action == 'resource_show':
+            return self.respond(200, {'success': True, 'result': self.resource_metadata(resource_id)})
+        if action == 'datastore_info':
+            return self.respond(200, {'success': True, 'result': {'meta': {'count': rows}, 'schema': SCHEMA}})
+        if action not in ['datastore_search', 'datastore_search_sql']:
+            return self.error(400, 'Bad Request', 'Bad request - Action name not known: {}'.format(action))
+
+        if action == 'datastore_search':
+            limit = min(int(data_dict.get('limit', 100)), config['max_limit'])
+            offset = int(data_dict.get('offset', 0))
+            if 'filters' in data_dict:
+                ids = data_dict['filters'].get('_id', [])
+                ids = [int(_id) for _id in (ids if isinstance(ids, list) else [ids]) if 1 <= int(_id) <= rows][:limit]
+            elif data_dict.get('sort') == '_id desc':
+                ids = range(rows - offset, max(rows - offset - limit, 0), -1)
+            else:
+                ids = range(offset + 1, min(offset + limit, rows) + 1)
+        else:
+            offset = 0
+            limit = min(limit, config['max_limit'])
+            ids = range(last_id + 1, min(last_id + limit, rows, up_to_id or rows) + 1)
+        time.sleep(config['latency'] + offset * config['offset_latency'])
+        if random.random() < config['throttle_rate']:
+            return self.error(429, 'Too Many Requests', 'Slow down', {'Retry-After': '1'})
+        if random.random() < config['error_rate']:
+            return self.error(500, 'Internal Server Error', 'Injected error')
+        records = [synthetic_record(_id, config['bad_rate']) for _id in ids]
+        fields = data_dict.get('fields')
+        if fields:
+            if isinstance(fields, str):
+                fields = fields.split(',')
+            records = [{f: r[f] for f in fields} for r in records]
+        self.respond(200, {'success': True, 'result': {'resource_id': resource_id, 'records': records, 'total': rows, 'limit': limit}})
+
+    def resource_metadata(self, resource_id):
+        return {'id': resource_id, 'name': resource_id, 'package_id': self.server.config['package_id'],
+                'datastore_active': True, 'last_modified': self.server.config.get('last_modified', '2020-01-01T00:00:00')}
+
+def serve_fake_ckan(config, port_queue):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeCKANHandler)
+    server.daemon_threads = True
+    server.config = config
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def start_fake_ckan(config):
+    # The server runs in a process of its own, so that generating and
+    # serializing the records doesn't compete for the GIL with the scan
+    # that is being measured.
+    port_queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve_fake_ckan, args=(config, port_queue), daemon=True)
+    process.start()
+    port = port_queue.get(timeout=30)
+    return process, 'http://127.0.0.1:{}'.format(port)
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux (and bytes on macOS).
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024*1024 if sys.platform == 'darwin' else 1024)
+
+def run_scenario(site, beeswax, kwargs):
+    # Each scenario is run in a fresh process, so that its peak memory use
+    # is its own and no caches or connections carry over from the last one.
+    # beekeeper gets its site from the credentials module, which is replaced
+    # here by one pointing at the fake CKAN server (so that the benchmark can
+    # never reach the real one).
+    credentials = types.ModuleType('credentials')
+    credentials.site = site
+    credentials.ckan_api_key = None
+    credentials.production = False
+    sys.modules['credentials'] = credentials
+    import io, contextlib
+    import beekeeper
+    baseline_rss = peak_rss_mb()
+    log = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(log):
+        results = beekeeper.mind_beeswax(beeswax, **kwargs)
+    seconds = time.perf_counter() - start
+    return {'seconds': seconds,
+            'baseline_rss_mb': baseline_rss,
+            'peak_rss_mb': peak_rss_mb(),
+            'checks': [{k: v for k, v in r.items() if k != 'output'} for r in results],
+            'log': log.getvalue()}
+
+def current_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmark(rows=(10000, 100000, 1000000), latency=0.005, offset_latency=0.0, error_rate=0.0, throttle_rate=0.0,
+        max_limit=32000, bad_rate=0.0, assertion='int', paging='offset', strategy='full', chunk_size=5000,
+        adaptive_paging=True, concurrency=4, requests_per_second=0, parallel_checks=4, repeat=1, seed=0,
+        output=None, verbose=False):
+    """Times a full mind_beeswax run (with one check) on a synthetic
+    datastore resource of each of the given sizes and prints rows/s and
+    peak memory for each.
+
+    latency is the time the fake server takes to answer each datastore
+    request, offset_latency is the extra time per row skipped by an OFFSET,
+    error_rate is the fraction of datastore requests that fail,
+    throttle_rate is the fraction that get a 429 response, max_limit is the
+    most rows the server returns per request, and bad_rate is the fraction
+    of rows whose OwnerZip isn't an integer (any bad rows make the 'int'
+    check fail, and a 'full' scan stops early).
+    The results (along with the git version of the code) are also saved to
+    output, if given, for comparison with other versions."""
+    if isinstance(rows, int):
+        rows = [rows]
+    random.seed(seed)
+    config = {'package_id': 'benchmark',
+            'resources': {'synthetic-{}'.format(n): n for n in rows},
+            'latency': latency,
+            'offset_latency': offset_latency,
+            'error_rate': error_rate,
+            'throttle_rate': throttle_rate,
+            'max_limit': max_limit,
+            'bad_rate': bad_rate}
+    server, site = start_fake_ckan(config)
+    scenarios = []
+    try:
+        for n in rows:
+            for k in range(repeat):
+                b = {'code': 'synthetic_{}'.format(n),
+                    'name': "Synthetic resource ({} rows)".format(n),
+                    'resource_id': 'synthetic-{}'.format(n),
+                    'field_name': 'OwnerZip',
+                    'assertion': assertion,
+                    'evaluation': 'client',
+                    'paging': paging,
+                    'strategy': strategy,
+                    'chunk_size': chunk_size,
+                    'adaptive_paging': adaptive_paging,
+                    'concurrency': concurrency,
+                    'requests_per_second': requests_per_second}
+                kwargs = {'mute_alerts': True, 'incremental': False, 'scan_state': {}, 'parallel_checks': parallel_checks}
+                with ProcessPoolExecutor(max_workers=1) as executor:
+                    result = executor.submit(run_scenario, site, [b], kwargs).result()
+                check = result['checks'][0]
+                if verbose:
+                    print(result['log'])
+                scenario = {'rows': n,
+                        'repeat': k,
+                        'status': check['status'],
+                        'seconds': result['seconds'],
+                        'rows_checked': check['rows'],
+                        'rows_per_second': check['rows'] / result['seconds'] if result['seconds'] > 0 else None,
+                        'pages': check['pages'],
+                        'page_seconds_p50': check['page_seconds_p50'],
+                        'page_seconds_p95': check['page_seconds_p95'],
+                        'retries': check['retries'],
+                        'megabytes': check['bytes'] / 1024**2,
+                        'baseline_rss_mb': result['baseline_rss_mb'],
+                        'peak_rss_mb': result['peak_rss_mb']}
+                scenarios.append(scenario)
+                print("{:>10} rows  {:<9}  {:>8.2f} s  {:>10.0f} rows/s  {:>6} pages  {:>4} retries  {:>8.1f} MB peak RSS".format(n,
+                    str(scenario['status']), scenario['seconds'], scenario['rows_per_second'] or 0, scenario['pages'],
+                    scenario['retries'], scenario['peak_rss_mb']))
+    finally:
+        server.terminate()
+
+    report = {'version': current_version(),
+            'run_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'settings': {'latency': latency, 'offset_latency': offset_latency, 'error_rate': error_rate,
+                'throttle_rate': throttle_rate, 'max_limit': max_limit, 'bad_rate': bad_rate, 'assertion': assertion, 'paging': paging, 'strategy': strategy,
+                'chunk_size': chunk_size, 'adaptive_paging': adaptive_paging, 'concurrency': concurrency, 'requests_per_second': requests_per_second, 'seed': seed},
+            'scenarios': scenarios}
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, ensure_ascii=True, indent = 4)
+    return report
+
+if __name__ == '__main__':
+    fire.Fire(run_benchmark, serialize=lambda report: None) # The results have already been printed.
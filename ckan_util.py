@@ -1,27 +1,210 @@
-import ckanapi
+import time, threading, requests, ckanapi
 
-def get_all_resources(package_id):
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+import metrics
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+def record_response_size(response, *args, **kwargs):
+    # Count the bytes that came over the wire (which, for a gzipped
+    # response, is its Content-Length rather than the length of the
+    # decompressed content).
+    size = response.headers.get('Content-Length')
+    metrics.current().record_bytes(int(size) if size is not None else len(response.content))
+
+# The Retry-After header of the last response each thread got.
+local = threading.local()
+
+def record_retry_after(response, *args, **kwargs):
+    local.retry_after = response.headers.get('Retry-After')
+
+def parse_retry_after(value):
+    # A Retry-After header is either a number of seconds or an HTTP date.
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+class CKANClient(ckanapi.RemoteCKAN):
+    """A RemoteCKAN that makes all of its calls through one requests Session,
+    so that TCP/TLS connections are kept alive and pooled across calls
+    (and threads) rather than being opened anew for every helper function.
+    Responses are requested gzipped, every call gets the same timeout, and
+    connection errors and 429/5xx responses are retried with exponential
+    backoff (honoring any Retry-After header). If a call still fails, the
+    exception gets a retry_after attribute (in seconds, or None) from the
+    last response's Retry-After header, so that the caller can back off
+    for as long as the server asked. No more than max_in_flight calls are
+    made at once, however many threads are using the client.
+
+    The calls made by a function wrapped with without_status_retries (like
+    the fetching of datastore pages) go through a second session that only
+    retries failed connections, so that 429/5xx responses and timeouts
+    reach the scan, which has its own retries (with a shrinking page size
+    and jittered backoff)."""
+    def __init__(self, site, API_key=None, timeout=60, retries=3, backoff_factor=0.5, pool_size=16, max_in_flight=8):
+        session = self.make_session(Retry(total=retries, backoff_factor=backoff_factor,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=None, # CKAN actions are POSTed, so retry those too.
+                respect_retry_after_header=True, raise_on_status=False), pool_size)
+        self.page_session = self.make_session(Retry(total=retries, connect=retries, read=False, status=0,
+                backoff_factor=backoff_factor, raise_on_status=False), pool_size)
+        super().__init__(site, apikey=API_key, user_agent='beekeeper', session=session)
+        self.site = site
+        self.timeout = timeout
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def make_session(self, retry, pool_size):
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        session.hooks['response'].append(record_response_size)
+        session.hooks['response'].append(record_retry_after)
+        return session
+
+    def without_status_retries(self, function):
+        # Wraps function so that the calls it makes through this client
+        # (in the thread that runs it) use the page session.
+        def unretried_function(*args, **kwargs):
+            local.page_call = True
+            try:
+                return function(*args, **kwargs)
+            finally:
+                local.page_call = False
+        return unretried_function
+
+    def _request_fn(self, url, data, headers, files, requests_kwargs):
+        session = self.page_session if getattr(local, 'page_call', False) else self.session
+        r = session.post(url, data=data, headers=headers, files=files, allow_redirects=False, **requests_kwargs)
+        return r.status_code, r.text
+
+    def call_action(self, action, data_dict=None, context=None, apikey=None, files=None, requests_kwargs=None):
+        requests_kwargs = dict(requests_kwargs or {})
+        requests_kwargs.setdefault('timeout', self.timeout)
+        with self.in_flight:
+            start = time.perf_counter()
+            local.retry_after = None
+            try:
+                return super().call_action(action, data_dict, context, apikey, files, requests_kwargs)
+            except Exception as e:
+                e.retry_after = parse_retry_after(local.retry_after)
+                # The errors that CKAN reports as such (like NotAuthorized,
+                # when datastore_search_sql is turned off) would just come
+                # back again, unlike 429s, 5xx errors, and connection
+                # failures.
+                e.retryable = not isinstance(e, (ckanapi.errors.NotAuthorized, ckanapi.errors.NotFound, ckanapi.errors.ValidationError,
+                    ckanapi.errors.SearchError, ckanapi.errors.SearchQueryError, ckanapi.errors.SearchIndexError))
+                raise
+            finally:
+                metrics.current().record_call(time.perf_counter() - start)
+
+clients = {}
+clients_lock = threading.Lock()
+
+def get_ckan(site, API_key=None, **client_options):
+    """Returns the shared CKANClient for the given site and API key, creating
+    it on first use."""
+    with clients_lock:
+        if (site, API_key) not in clients:
+            clients[(site, API_key)] = CKANClient(site, API_key, **client_options)
+        return clients[(site, API_key)]
+
+class MetadataCache():
+    """Caches the results of CKAN metadata calls (package_show, resource_show,
+    datastore_info) by site, action, and ID for ttl seconds, so that a run
+    with many checks against the same package only pays for that package's
+    metadata once."""
+    def __init__(self, ttl=600):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        with self.lock:
+            if key in self.entries:
+                stored_at, value = self.entries[key]
+                if time.monotonic() - stored_at < self.ttl:
+                    return value
+                del self.entries[key]
+        return None
+
+    def store(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+
+    def get(self, key, fetch):
+        value = self.lookup(key)
+        if value is None:
+            value = fetch()
+            self.store(key, value)
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+metadata_cache = MetadataCache()
+
+def cached_package_show(site, package_id, API_key=None, ckan=None):
+    def fetch():
+        client = ckan or get_ckan(site, API_key)
+        metadata = client.action.package_show(id=package_id)
+        # package_show already includes the metadata of every resource in
+        # the package, so those can be used to answer resource_show calls.
+        for resource in metadata.get('resources', []):
+            metadata_cache.store((site, 'resource_show', resource['id']), resource)
+        return metadata
+    return metadata_cache.get((site, 'package_show', package_id), fetch)
+
+def cached_resource_show(site, resource_id, API_key=None, ckan=None):
+    def fetch():
+        client = ckan or get_ckan(site, API_key)
+        return client.action.resource_show(id=resource_id)
+    return metadata_cache.get((site, 'resource_show', resource_id), fetch)
+
+def get_datastore_info(site, resource_id, API_key=None, ckan=None):
+    """Returns the result of a single datastore_info call, which has both
+    the row count (under 'meta') and the schema of the datastore."""
+    def fetch():
+        client = ckan or get_ckan(site, API_key)
+        return client.action.datastore_info(id=resource_id)
+    return metadata_cache.get((site, 'datastore_info', resource_id), fetch)
+
+def get_all_resources(package_id, ckan=None):
     from credentials import site, ckan_api_key as API_key
-    ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
-    metadata = ckan.action.package_show(id=package_id)
+    metadata = cached_package_show(site, package_id, API_key, ckan)
     return metadata['resources']
 
-def get_resource_metadata(resource_id):
+def get_resource_metadata(resource_id, ckan=None):
     from credentials import site, ckan_api_key as API_key
-    ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
-    metadata = ckan.action.resource_show(id=resource_id)
+    metadata = cached_resource_show(site, resource_id, API_key, ckan)
     return metadata
 
-def has_public_datastore(resource_id):
-    metadata = get_resource_metadata(resource_id)
+def has_public_datastore(resource_id, ckan=None):
+    metadata = get_resource_metadata(resource_id, ckan)
     return metadata['datastore_active']
 
 
-def package_id_of(b):
+def package_id_of(b, ckan=None):
     if 'package_id' in b:
         return b['package_id']
     if 'resource_id' in b:
-        metadata = get_resource_metadata(b['resource_id'])
+        metadata = get_resource_metadata(b['resource_id'], ckan)
         return metadata['package_id']
     raise ValueError(f"Unable to find package ID for {b}.")
 
@@ -31,7 +214,7 @@ def make_package_private(b):
     set_package_parameters_to_values(site, package_id, ['private'], [True], API_key)
     print(f"Made the package {package_id} private.")
 
-def get_package_parameter(site,package_id,parameter=None,API_key=None):
+def get_package_parameter(site,package_id,parameter=None,API_key=None,ckan=None):
     """Gets a CKAN package parameter. If no parameter is specified, all metadata
     for that package is returned."""
     # Some package parameters you can fetch from the WPRDC with
@@ -47,8 +230,7 @@ def get_package_parameter(site,package_id,parameter=None,API_key=None):
     # 'name', 'isopen', 'url', 'notes', 'license_title',
     # 'temporal_coverage', 'related_documents', 'license_url',
     # 'organization', 'revision_id'
-    ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
-    metadata = ckan.action.package_show(id=package_id)
+    metadata = cached_package_show(site, package_id, API_key, ckan)
     if parameter is None:
         return metadata
     else:
@@ -57,21 +239,23 @@ def get_package_parameter(site,package_id,parameter=None,API_key=None):
         else:
             return None
 
-def set_package_parameters_to_values(site, package_id, parameters, new_values, API_key):
-    ckan = ckanapi.RemoteCKAN(site, apikey=API_key)
-    original_values = [get_package_parameter(site,package_id,p,API_key) for p in parameters]
+def set_package_parameters_to_values(site, package_id, parameters, new_values, API_key, ckan=None):
+    if ckan is None:
+        ckan = get_ckan(site, API_key)
+    original_values = [get_package_parameter(site,package_id,p,API_key,ckan) for p in parameters]
     payload = {}
     payload['id'] = package_id
     for parameter,new_value in zip(parameters,new_values):
         payload[parameter] = new_value
     results = ckan.action.package_patch(**payload)
+    metadata_cache.invalidate((site, 'package_show', package_id))
     #print(results)
     print("Changed the parameters {} from {} to {} on package {}".format(parameters, original_values, new_values, package_id))
 
-def package_is_private(site, package_id, API_key=None):
-    return get_package_parameter(site, package_id, 'private', API_key)
+def package_is_private(site, package_id, API_key=None, ckan=None):
+    return get_package_parameter(site, package_id, 'private', API_key, ckan)
 
-def resource_is_private(site, resource_id, API_key=None):
-    metadata = get_resource_metadata(resource_id)
+def resource_is_private(site, resource_id, API_key=None, ckan=None):
+    metadata = get_resource_metadata(resource_id, ckan)
     package_id = metadata['package_id']
-    return get_package_parameter(site, package_id, 'private', API_key)
+    return get_package_parameter(site, package_id, 'private', API_key, ckan)
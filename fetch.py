@@ -1,4 +1,4 @@
-import os, csv
+import os, io, re, csv, json, gzip, mmap, codecs, zipfile, threading
 
 from parameters.local_parameters import CITY_KEYFILEPATH, REFERENCE_DIR
 
@@ -13,15 +13,130 @@ def local_dir(base_dir):
         os.makedirs(local_directory)
     return local_directory
 
+class DirectorySource():
+    """A reference-file source backed by a local (or mounted) directory,
+    which has the same interface as SFTPSource, so it can stand in for an
+    SFTP server."""
+    def __init__(self, root):
+        self.root = root
+        self.lock = threading.Lock()
+
+    def stat(self, remote_path):
+        st = os.stat(os.path.join(self.root, remote_path.lstrip('/')))
+        return st.st_size, int(st.st_mtime)
+
+    def open(self, remote_path, offset=0):
+        f = open(os.path.join(self.root, remote_path.lstrip('/')), 'rb')
+        f.seek(offset)
+        return f
+
+    def close(self):
+        pass
+
+class SFTPSource():
+    """A reference-file source on an SFTP server. One SSH connection (and
+    SFTP session) is opened on first use and reused for every file fetched
+    from the server during the run."""
+    def __init__(self, host, username, key_filepath, port=22):
+        self.host = host
+        self.username = username
+        self.key_filepath = key_filepath
+        self.port = port
+        self.ssh = None
+        self.sftp = None
+        self.lock = threading.Lock()
+
+    def session(self):
+        if self.sftp is None:
+            import paramiko # Only needed when files are actually fetched over SFTP.
+            self.ssh = paramiko.SSHClient()
+            self.ssh.load_system_host_keys()
+            self.ssh.connect(self.host, port=self.port, username=self.username, key_filename=self.key_filepath)
+            self.sftp = self.ssh.open_sftp()
+        return self.sftp
+
+    def stat(self, remote_path):
+        attributes = self.session().stat(remote_path)
+        return attributes.st_size, int(attributes.st_mtime)
+
+    def open(self, remote_path, offset=0):
+        # Returns the file, ready to be read from offset on.
+        f = self.session().open(remote_path, 'rb')
+        f.seek(offset) # (Before prefetching, which reads ahead from the current position.)
+        f.prefetch() # Pipeline the reads instead of waiting on each block.
+        return f
+
+    def close(self):
+        if self.ssh is not None:
+            self.ssh.close()
+        self.ssh = None
+        self.sftp = None
+
+def read_json_file(filepath):
+    if os.path.exists(filepath):
+        try:
+            with open(filepath, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            pass
+    return None
+
+def fetch_reference_file(source, remote_path, local_directory, block_size=1024*1024):
+    """Fetches remote_path from source into local_directory, unless the copy
+    already there came from a remote file with the same size and mtime.
+    The download goes to a .part file (resuming where an earlier, partial
+    download of the same remote file left off) which is renamed into place
+    once it is complete, so a failed or half-finished transfer never looks
+    like a good reference file. Failures raise exceptions."""
+    local_filepath = os.path.join(local_dir(local_directory), os.path.basename(remote_path))
+    part_filepath = local_filepath + '.part'
+    with source.lock: # Transfers over one session are done one at a time.
+        size, mtime = source.stat(remote_path)
+        remote = {'size': size, 'mtime': mtime}
+        if os.path.exists(local_filepath) and os.path.getsize(local_filepath) == size and read_json_file(local_filepath + '.remote.json') == remote:
+            return local_filepath
+
+        offset = 0
+        if os.path.exists(part_filepath) and read_json_file(part_filepath + '.remote.json') == remote:
+            offset = os.path.getsize(part_filepath)
+        if offset > size:
+            offset = 0
+        with open(part_filepath + '.remote.json', 'w') as f:
+            json.dump(remote, f)
+        if offset:
+            print(f"Resuming the download of {remote_path} at byte {offset}.")
+        with source.open(remote_path, offset) as remote_file, open(part_filepath, 'ab' if offset else 'wb') as local_file:
+            while True:
+                block = remote_file.read(block_size)
+                if not block:
+                    break
+                local_file.write(block)
+        if os.path.getsize(part_filepath) != size:
+            raise ValueError(f"The download of {remote_path} has {os.path.getsize(part_filepath)} bytes instead of {size}.")
+        os.replace(part_filepath, local_filepath)
+        os.replace(part_filepath + '.remote.json', local_filepath + '.remote.json')
+    return local_filepath
+
+sources = {}
+sources_lock = threading.Lock()
+
+def city_source():
+    with sources_lock:
+        if 'pgh' not in sources:
+            sources['pgh'] = SFTPSource('ftp.pittsburghpa.gov', 'pitt', CITY_KEYFILEPATH)
+        return sources['pgh']
+
+def close_sources():
+    with sources_lock:
+        for source in sources.values():
+            source.close()
+        sources.clear()
+
 def fetch_city_file(filename):
     """For this function to be able to get a file from the City's FTP server,
     it needs to be able to access the appropriate key file."""
     local_directory = local_dir(REFERENCE_DIR)
-    cmd = "sftp -i {} pitt@ftp.pittsburghpa.gov:/pitt/{} {}".format(CITY_KEYFILEPATH, filename, local_directory)
-    results = os.popen(cmd).readlines()
-    #for result in results:
-    #    print(" > {}".format(result))
-    return local_directory + '/' + filename #results
+    return fetch_reference_file(city_source(), '/pitt/{}'.format(filename), local_directory)
 
 def fetch_data_file(b):
     if 'reference' not in b:
@@ -38,9 +153,75 @@ def fetch_data_file(b):
         directory = ref.get('directory', '')
         local_filepath = fetch_city_file(filename)
         return local_filepath
+    elif ref['type'] == 'directory': # A local directory standing in for a server.
+        source = DirectorySource(ref['directory'])
+        return fetch_reference_file(source, ref['file'], local_dir(REFERENCE_DIR))
     else:
         raise ValueError(f"get_data does not know how to handle a reference dict of {ref}.")
 
-def get_data_by_field(local_filepath, field):
-    reader = csv.DictReader(open(local_filepath))
-    return [row[field] for row in reader]
+def read_lines(local_filepath):
+    """Yields the lines of a (possibly gzipped or zipped) CSV file as text.
+    Plain files are memory-mapped rather than read through a buffer."""
+    if local_filepath.endswith('.gz'):
+        with gzip.open(local_filepath, 'rt', encoding='utf-8-sig', newline='') as f:
+            yield from f
+    elif local_filepath.endswith('.zip'):
+        with zipfile.ZipFile(local_filepath) as z:
+            names = [n for n in z.namelist() if not n.endswith('/')]
+            csv_names = [n for n in names if n.lower().endswith('.csv')]
+            if len(csv_names) == 0 and len(names) != 1:
+                raise ValueError(f"Unable to tell which file in {local_filepath} to read.")
+            with z.open((csv_names or names)[0]) as member:
+                yield from io.TextIOWrapper(member, encoding='utf-8-sig', newline='')
+    else:
+        with open(local_filepath, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield from codecs.iterdecode(iter(mm.readline, b''), 'utf-8-sig')
+
+def parse_column(local_filepath, field, as_set=False):
+    # Only the requested column is pulled out of each row (by its index in
+    # the header), rather than building a dict for every row. With as_set,
+    # the values go straight into a set, without a list of all of them
+    # being built first.
+    reader = csv.reader(read_lines(local_filepath))
+    header = next(reader, [])
+    if field not in header:
+        raise ValueError(f"Unable to find a field called '{field}' in {local_filepath}.")
+    index = header.index(field)
+    if as_set:
+        return {row[index] if len(row) > index else None for row in reader}
+    return [row[index] if len(row) > index else None for row in reader]
+
+def column_cache_path(local_filepath, field, as_set=False):
+    # The distinct values (for as_set) are cached separately from the full column.
+    return "{}.{}.{}.json".format(local_filepath, re.sub(r'[^\w-]', '_', field), 'values' if as_set else 'column')
+
+def get_data_by_field(local_filepath, field, as_set=False):
+    """Returns the values in the given column of a CSV file (as a list, or
+    as a set if as_set is True). The parsed column is cached next to the
+    file, keyed by the file's size and modification time, so that an
+    unchanged file doesn't get parsed again on the next run."""
+    stat = os.stat(local_filepath)
+    cache_path = column_cache_path(local_filepath, field, as_set)
+    values = None
+    if os.path.exists(cache_path):
+        try:
+            with open(cache_path, 'r') as f:
+                cached = json.load(f)
+            if cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+                values = cached['values']
+        except (ValueError, KeyError):
+            pass # A cache file that can't be read just gets rewritten.
+    if values is None:
+        values = parse_column(local_filepath, field, as_set)
+        temp_path = cache_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'size': stat.st_size, 'mtime': stat.st_mtime,
+                'values': sorted(values, key=lambda v: (v is None, v or '')) if as_set else values}, f)
+        os.replace(temp_path, cache_path)
+        return values
+    if as_set:
+        return set(values)
+    return values
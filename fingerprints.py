@@ -0,0 +1,70 @@
+import hashlib
+
+# A field's fingerprints are a hash of its values (with their _id values) in
+# each range of range_size _id values, computed by the datastore (see
+# get_fingerprints in beekeeper.py), combined into a Merkle-style tree: the
+# range hashes are the leaves, and each level up hashes pairs of nodes from
+# the level below, up to a single root. Two sets of fingerprints with the
+# same root have the same values in every range, and where the roots
+# differ, walking down the branches that differ finds the changed ranges
+# without comparing the rest.
+#
+# They are stored in the scan state like this:
+#    {'field_name': 'OwnerZip', 'range_size': 10000, 'root': '...',
+#     'leaves': {'0': '...', '1': '...', ...}} # Range number -> hash
+# where range k covers _id values from k*range_size + 1 to (k+1)*range_size.
+
+def hash_text(text):
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+def merkle_levels(leaves):
+    # Returns the levels of the tree, from the leaves (ordered by range
+    # number) up to the root. A node without a partner is carried up as is.
+    levels = [[hash_text("{}:{}".format(k, leaves[k])) for k in sorted(leaves, key=int)]]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        levels.append([hash_text(''.join(level[k:k+2])) if k + 1 < len(level) else level[k] for k in range(0, len(level), 2)])
+    return levels
+
+def make_fingerprints(field_name, range_size, leaves):
+    levels = merkle_levels(leaves)
+    return {'field_name': field_name,
+            'range_size': range_size,
+            'root': levels[-1][0] if levels[-1] else hash_text(''),
+            'leaves': leaves}
+
+def comparable(old, new):
+    return old is not None and new is not None and (old['field_name'], old['range_size']) == (new['field_name'], new['range_size'])
+
+def changed_leaves(old, new):
+    # Returns the sorted numbers of the ranges whose hashes differ (including
+    # ranges that are new, but not ones that are now empty, which have no
+    # rows to check). If the ranges themselves are the same, the trees are
+    # walked from the root down, skipping matching branches.
+    if old['root'] == new['root']:
+        return []
+    if sorted(old['leaves'], key=int) != sorted(new['leaves'], key=int):
+        return sorted(int(k) for k in new['leaves'] if old['leaves'].get(k) != new['leaves'][k])
+    old_levels, new_levels = merkle_levels(old['leaves']), merkle_levels(new['leaves'])
+    positions = [0]
+    for depth in range(len(new_levels) - 1, 0, -1):
+        children = []
+        for position in positions:
+            for child in [2 * position, 2 * position + 1]:
+                if child < len(new_levels[depth - 1]) and old_levels[depth - 1][child] != new_levels[depth - 1][child]:
+                    children.append(child)
+        positions = children
+    ordered_keys = sorted(new['leaves'], key=int)
+    return [int(ordered_keys[position]) for position in positions]
+
+def leaf_ranges(leaves, range_size):
+    # Turns range numbers into (first _id, last _id) pairs, merging
+    # neighbors.
+    ranges = []
+    for k in sorted(leaves):
+        low, high = k * range_size + 1, (k + 1) * range_size
+        if ranges and ranges[-1][1] + 1 == low:
+            ranges[-1] = (ranges[-1][0], high)
+        else:
+            ranges.append((low, high))
+    return ranges
@@ -0,0 +1,130 @@
+import math, time, threading
+
+# The CheckMetrics of the check that the current thread is working on
+# (if any) are kept here, so that code deep in the call stack (like the
+# CKAN client) can record what it does without having the metrics passed
+# all the way down to it.
+local = threading.local()
+
+def percentile(xs, p):
+    # Nearest-rank percentile of a list of numbers (None if it's empty).
+    if len(xs) == 0:
+        return None
+    ordered = sorted(xs)
+    k = max(0, min(len(ordered) - 1, math.ceil(p/100.0 * len(ordered)) - 1))
+    return ordered[k]
+
+class CheckMetrics():
+    """Timing and throughput measurements for one check: metadata calls,
+    page fetch latencies, assertion CPU time, rows checked, bytes
+    transferred, retries, and time spent sleeping to respect rate limits."""
+    def __init__(self, code=None, name=None):
+        self.code = code
+        self.name = name
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.finished = None
+        self.status = None
+        self.metadata_calls = 0
+        self.metadata_seconds = 0.0
+        self.page_latencies = []
+        self.assertion_cpu_seconds = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.retries = 0
+        self.sleep_seconds = 0.0
+
+    def activate(self):
+        # Make these the metrics that calls made by this thread are recorded in.
+        local.metrics = self
+
+    def page(self, fetch_chunk):
+        # Wraps a chunk-fetching function (which will run on some other
+        # thread) so that its calls are timed as page fetches.
+        def timed_fetch_chunk(*args):
+            previous = getattr(local, 'metrics', None)
+            local.metrics = self
+            local.in_page = True
+            start = time.perf_counter()
+            try:
+                return fetch_chunk(*args)
+            finally:
+                self.record_page(time.perf_counter() - start)
+                local.in_page = False
+                local.metrics = previous
+        return timed_fetch_chunk
+
+    def record_page(self, seconds):
+        with self.lock:
+            self.page_latencies.append(seconds)
+
+    def record_call(self, seconds):
+        # Calls that aren't made while fetching a page are metadata calls.
+        if not getattr(local, 'in_page', False):
+            with self.lock:
+                self.metadata_calls += 1
+                self.metadata_seconds += seconds
+
+    def record_bytes(self, n):
+        with self.lock:
+            self.bytes += n
+
+    def record_rows(self, n):
+        with self.lock:
+            self.rows += n
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def record_sleep(self, seconds):
+        with self.lock:
+            self.sleep_seconds += seconds
+
+    def record_assertion(self, cpu_seconds):
+        with self.lock:
+            self.assertion_cpu_seconds += cpu_seconds
+
+    def finish(self, status):
+        self.status = status
+        self.finished = time.time()
+
+    def summary(self):
+        with self.lock:
+            seconds = (self.finished or time.time()) - self.started
+            return {'code': self.code,
+                    'name': self.name,
+                    'status': self.status,
+                    'seconds': seconds,
+                    'metadata_calls': self.metadata_calls,
+                    'metadata_seconds': self.metadata_seconds,
+                    'pages': len(self.page_latencies),
+                    'page_seconds_p50': percentile(self.page_latencies, 50),
+                    'page_seconds_p95': percentile(self.page_latencies, 95),
+                    'page_seconds_max': max(self.page_latencies) if self.page_latencies else None,
+                    'assertion_cpu_seconds': self.assertion_cpu_seconds,
+                    'rows': self.rows,
+                    'rows_per_second': self.rows/seconds if seconds > 0 else None,
+                    'bytes': self.bytes,
+                    'retries': self.retries,
+                    'sleep_seconds': self.sleep_seconds}
+
+# Metrics recorded outside of any check go here and are never reported.
+unreported = CheckMetrics()
+
+def current():
+    return getattr(local, 'metrics', None) or unreported
+
+def prometheus_text(summaries):
+    """Formats check summaries in the Prometheus textfile-collector format."""
+    lines = []
+    for key, value in summaries[0].items() if summaries else []:
+        if key in ['code', 'name', 'status']:
+            continue
+        metric = 'beekeeper_check_{}'.format(key)
+        lines.append('# TYPE {} gauge'.format(metric))
+        for s in summaries:
+            if s[key] is not None:
+                label = (s['code'] or s['name']).replace('\\', '\\\\').replace('"', '\\"')
+                lines.append('{}{{check="{}",status="{}"}} {}'.format(metric, label, s['status'], s[key]))
+    return '\n'.join(lines) + '\n'
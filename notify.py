@@ -1,33 +1,48 @@
-def send_to_slack(message,username=None,channel=None,icon=None,slack_group='wprdc'):
-    """This script sends the given message to a particular channel on
-    Slack, as configured by the webhook_url. Note that this shouldn't 
-    be heavily used (e.g., for reporting every error a script 
-    encounters) as API limits are a consideration. This script IS 
-    suitable for running when a script-terminating exception is caught, 
-    so that you can report the irregular termination of an ETL script."""
-    from parameters.remote_parameters import webhook_url, webhook_by_group
+import os, re, json, time, socket, threading
 
-    import os, re, json, requests
-    import socket
+from functools import lru_cache
+
+from scan import backoff_delay
+
+@lru_cache(maxsize=None)
+def caboose():
+    # Looking up the hostname and IP address can be slow, so it's only
+    # done once.
     IP_address = socket.gethostbyname(socket.gethostname())
     hostname = re.sub(".local","",socket.gethostname())
     name_of_current_script = os.path.basename(__file__)
+    return "(Sent from {} running on a computer called {} at {}.)".format(name_of_current_script, hostname, IP_address)
 
-    caboose = "(Sent from {} running on a computer called {} at {}.)".format(name_of_current_script, hostname, IP_address)
-    # Set the webhook_url to the one provided by Slack when you create the webhook at https://my.slack.com/services/new/incoming-webhook/
-    slack_data = {'text': message + " " + caboose}
+def webhook_for(slack_group='wprdc'):
+    from parameters.remote_parameters import webhook_url, webhook_by_group
+    if slack_group != 'wprdc':
+        return webhook_by_group[slack_group]
+    return webhook_url
+
+def slack_payload(message, username=None, channel=None, icon=None):
+    slack_data = {'text': message + " " + caboose()}
     slack_data['username'] = 'TACHYON'
     if username is not None:
         slack_data['username'] = username
-    #To send this as a direct message instead, use the following line. 
+    #To send this as a direct message instead, use the following line.
     if channel is not None:
         slack_data['channel'] = channel
     if icon is not None:
         slack_data['icon_emoji'] = icon #':coffin:' #':tophat:' # ':satellite_antenna:'
-    if slack_group != 'wprdc':
-        webhook_url = webhook_by_group[slack_group]
+    return slack_data
+
+def send_to_slack(message,username=None,channel=None,icon=None,slack_group='wprdc'):
+    """This script sends the given message to a particular channel on
+    Slack, as configured by the webhook_url. Note that this shouldn't
+    be heavily used (e.g., for reporting every error a script
+    encounters) as API limits are a consideration. This script IS
+    suitable for running when a script-terminating exception is caught,
+    so that you can report the irregular termination of an ETL script.
+    (To send many messages, use a NotificationQueue.)"""
+    import requests
+    # Set the webhook_url to the one provided by Slack when you create the webhook at https://my.slack.com/services/new/incoming-webhook/
     response = requests.post(
-        webhook_url, data=json.dumps(slack_data),
+        webhook_for(slack_group), data=json.dumps(slack_payload(message, username, channel, icon)),
         headers={'Content-Type': 'application/json'}
     )
     if response.status_code != 200:
@@ -36,6 +51,129 @@ def send_to_slack(message,username=None,channel=None,icon=None,slack_group='wprd
             % (response.status_code, response.text)
         )
 
+class NotificationQueue():
+    """Collects Slack messages and sends them from a background thread, so
+    that whoever is sending them never waits on (or gets an exception from)
+    Slack. Every flush_interval seconds (or when flush() is called), the
+    messages that have piled up for each channel (and username, icon, and
+    Slack group) are combined into digests of up to max_length characters.
+
+    The digests are posted no faster than messages_per_second (Slack allows
+    about one per second per webhook). A post that gets a 429 response is
+    retried after its Retry-After time, and one that gets a 5xx response
+    or a connection error is retried after a jittered exponential backoff,
+    up to retries times in all. A digest that can't be sent is printed
+    instead.
+
+    If webhook_url is given, everything is posted there (like to a local
+    stand-in for Slack, for testing). Otherwise, each Slack group's webhook
+    comes from parameters.remote_parameters."""
+    def __init__(self, webhook_url=None, flush_interval=30, max_length=3500, messages_per_second=1, retries=5, timeout=10):
+        self.webhook_url = webhook_url
+        self.flush_interval = flush_interval
+        self.max_length = max_length
+        self.interval = 1.0/messages_per_second
+        self.retries = retries
+        self.timeout = timeout
+        self.pending = {}
+        self.sending = False
+        self.flush_requested = False
+        self.condition = threading.Condition()
+        self.worker = None
+        self.session = None
+        self.last_post = 0
+
+    def put(self, message, username=None, channel=None, icon=None, slack_group='wprdc'):
+        with self.condition:
+            self.pending.setdefault((slack_group, channel, username, icon), []).append(message)
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.run, name='notifications', daemon=True)
+                self.worker.start()
+
+    def flush(self, timeout=120):
+        # Sends everything that has been put so far, waiting up to timeout
+        # seconds for it to go out. Returns whether it did.
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            if self.worker is None:
+                return True
+            while self.pending or self.sending or self.flush_requested:
+                if self.pending: # (Including any put while the last batch was being sent.)
+                    self.flush_requested = True
+                    self.condition.notify_all()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.flush_requested, self.flush_interval)
+                batches, self.pending = self.pending, {}
+                self.sending = True
+                self.flush_requested = False
+            try:
+                for key, messages in batches.items():
+                    for digest in self.digests(messages):
+                        self.post(key, digest)
+            except Exception as e: # The worker has to keep going, whatever happens.
+                print("Unable to send Slack notifications: {}".format(e))
+            finally:
+                with self.condition:
+                    self.sending = False
+                    self.condition.notify_all()
+
+    def digests(self, messages):
+        # Combines the messages into as few texts of up to max_length
+        # characters as possible (splitting any message that is too long on
+        # its own).
+        pieces = []
+        for message in messages:
+            pieces += [message[k:k+self.max_length] for k in range(0, max(len(message), 1), self.max_length)]
+        digests = []
+        for piece in pieces:
+            if digests and len(digests[-1]) + 2 + len(piece) <= self.max_length:
+                digests[-1] += '\n\n' + piece
+            else:
+                digests.append(piece)
+        return digests
+
+    def post(self, key, text):
+        import requests
+        if self.session is None:
+            self.session = requests.Session()
+        slack_group, channel, username, icon = key
+        payload = json.dumps(slack_payload(text, username, channel, icon))
+        failures = 0
+        while failures < self.retries:
+            wait = self.last_post + self.interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.last_post = time.monotonic()
+            retry_after = None
+            try:
+                response = self.session.post(self.webhook_url or webhook_for(slack_group), data=payload,
+                        headers={'Content-Type': 'application/json'}, timeout=self.timeout)
+                if response.status_code == 200:
+                    return True
+                problem = 'Slack returned an error {}: {}'.format(response.status_code, response.text)
+                if response.status_code != 429 and response.status_code < 500:
+                    failures = self.retries # Retrying won't help.
+                retry_after = response.headers.get('Retry-After')
+            except requests.RequestException as e:
+                problem = 'Unable to reach Slack: {}'.format(e)
+            failures += 1
+            if failures < self.retries:
+                try:
+                    retry_after = float(retry_after) if retry_after is not None else None
+                except ValueError:
+                    retry_after = None
+                time.sleep(backoff_delay(failures, retry_after))
+        print("{} This notification was not sent:\n{}".format(problem, text))
+        return False
+
 if __name__ == '__main__':
     msg = "No sir, away! A papaya war is on!"
     send_to_slack(msg,username='notifybot',channel='@david')
@@ -0,0 +1,102 @@
+from collections import Counter
+
+def normalize(value):
+    # Reference values come out of CSV files as strings, while the same
+    # values in a CKAN datastore may be integers, floats, or padded text,
+    # so everything is compared as stripped strings.
+    if value is None:
+        return ''
+    return str(value).strip()
+
+class ReferenceValues():
+    """A hashed collection of the (normalized) reference values that are
+    expected to show up in a CKAN datastore field. Each value pulled from
+    the datastore is consumed in constant time, and whatever has not been
+    consumed by the end of the scan is the list of leftovers.
+
+    By default, a value seen once in the datastore accounts for every
+    copy of that value in the reference file. When count_duplicates is
+    True, each datastore value only accounts for a single copy, so a
+    reference file listing a value three times needs three matching
+    records."""
+    def __init__(self, values=None, count_duplicates=False):
+        self.count_duplicates = count_duplicates
+        if values is None:
+            values = []
+        normalized = (normalize(v) for v in values)
+        if count_duplicates:
+            self.remaining = Counter(normalized)
+        else:
+            self.remaining = set(normalized)
+
+    def consume(self, value):
+        v = normalize(value)
+        if self.count_duplicates:
+            if v in self.remaining:
+                self.remaining[v] -= 1
+                if self.remaining[v] <= 0:
+                    del self.remaining[v]
+        else:
+            self.remaining.discard(v)
+
+    def consume_chunk(self, values):
+        if self.count_duplicates:
+            for v in values:
+                self.consume(v)
+        else:
+            self.remaining.difference_update(normalize(v) for v in values)
+
+    def leftovers(self):
+        if self.count_duplicates:
+            return sorted(self.remaining.elements())
+        return sorted(self.remaining)
+
+    def __len__(self):
+        if self.count_duplicates:
+            return sum(self.remaining.values())
+        return len(self.remaining)
+
+class DeferredReferenceValues(ReferenceValues):
+    """ReferenceValues whose values are still being fetched (by the given
+    concurrent.futures Future, which should return a list or set of values)
+    while the datastore is being scanned. Until they arrive, the datastore
+    values are tallied up, and they are then all struck from the reference
+    values at once."""
+    def __init__(self, future, count_duplicates=False):
+        self.future = future
+        self.count_duplicates = count_duplicates
+        self.remaining = None
+        self.seen = Counter() if count_duplicates else set()
+
+    def resolve(self, wait=False):
+        if self.remaining is None and (wait or self.future.done()):
+            super().__init__(self.future.result(), self.count_duplicates)
+            seen, self.seen = self.seen, None
+            if self.count_duplicates:
+                self.remaining.subtract(seen)
+                self.remaining = +self.remaining # Drop the counts that are now zero or below.
+            else:
+                self.remaining.difference_update(seen)
+        return self.remaining is not None
+
+    def consume(self, value):
+        if self.resolve():
+            super().consume(value)
+        elif self.count_duplicates:
+            self.seen[normalize(value)] += 1
+        else:
+            self.seen.add(normalize(value))
+
+    def consume_chunk(self, values):
+        if self.resolve():
+            super().consume_chunk(values)
+        else: # Works for both a Counter and a set.
+            self.seen.update(normalize(v) for v in values)
+
+    def leftovers(self):
+        self.resolve(wait=True)
+        return super().leftovers()
+
+    def __len__(self):
+        self.resolve(wait=True)
+        return super().__len__()
@@ -0,0 +1,307 @@
+import sys, time, random, threading, traceback
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+class RateLimiter():
+    """Spaces out calls to wait() so that no more than requests_per_second
+    of them get through, no matter how many threads are calling it."""
+    def __init__(self, requests_per_second=None):
+        self.interval = 0 if not requests_per_second else 1.0/requests_per_second
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        # Returns the number of seconds spent waiting.
+        if self.interval == 0:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+            return slot - now
+        return 0
+
+class ChunkFetchError(Exception):
+    pass
+
+def is_retryable(e):
+    # An error that the client marks as not retryable (like a request that
+    # the server refuses, which it would just refuse again) isn't retried.
+    return getattr(e, 'retryable', True)
+
+def backoff_delay(failures, retry_after=None, base=0.5, cap=60, rng=random):
+    # Exponential backoff with full jitter: after the nth failure in a row,
+    # wait a random time of up to base*2^(n-1) seconds (but never more than
+    # cap), so that retries from several threads don't all land at once.
+    # If the server said how long to wait (with a Retry-After header), wait
+    # at least that long.
+    delay = rng.uniform(0, min(cap, base * 2 ** (failures - 1)))
+    if retry_after is not None:
+        delay = max(delay, min(cap, retry_after))
+    return delay
+
+class AdaptivePager():
+    """Picks how many rows to ask for in each request. The page size is
+    doubled while pages come back in under half of target_seconds and is
+    halved when a page takes longer than target_seconds or fails (a timeout
+    or 5xx error), always staying between min_size and max_size.
+
+    When a page comes back with fewer rows than were asked for (though
+    more were available), the server is capping the limit (like CKAN's
+    ckan.datastore.search.rows_max), so max_size is lowered to match. If
+    adaptive is False, the page size stays fixed (apart from that cap)."""
+    def __init__(self, size=5000, min_size=100, max_size=32000, target_seconds=2.0, adaptive=True):
+        self.min_size = min_size
+        self.max_size = max(max_size, min_size)
+        self.size = max(min_size, min(size, self.max_size))
+        self.target_seconds = target_seconds
+        self.adaptive = adaptive
+
+    def record_page(self, seconds):
+        if not self.adaptive:
+            return
+        if seconds > self.target_seconds:
+            self.size = max(self.min_size, self.size // 2)
+        elif seconds < self.target_seconds / 2:
+            self.size = min(self.max_size, self.size * 2)
+
+    def record_failure(self):
+        if self.adaptive:
+            self.size = max(self.min_size, self.size // 2)
+
+    def record_cap(self, rows_returned):
+        # A short page that is smaller than min_size is more likely to be
+        # the end of the data than a cap.
+        if self.min_size <= rows_returned < self.max_size:
+            self.max_size = rows_returned
+            self.size = min(self.size, self.max_size)
+
+def format_exception():
+    exc_type, exc_value, exc_traceback = sys.exc_info()
+    lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
+    return ''.join('!! ' + line for line in lines)
+
+def fetch_chunks(fetch_chunk, offsets, concurrency=4, requests_per_second=10, failure_limit=5, metrics=None):
+    """Calls fetch_chunk(offset) for every offset, keeping up to concurrency
+    requests in flight and starting no more than requests_per_second of
+    them per second, and yields (offset, records) pairs in the order in
+    which the chunks arrive (which need not be the order of the offsets).
+
+    A chunk that fails is retried (after a jittered exponential backoff,
+    or as long as the error's retry_after says) until it has failed
+    failure_limit times in a row, at which point ChunkFetchError is raised
+    (as it is right away for an error that isn't retryable). Closing the generator early (e.g., because an assertion has already
+    failed) cancels the requests that have not been started yet.
+
+    Retries and time spent waiting on the rate limiter or backing off are
+    recorded in metrics (a CheckMetrics), if given."""
+    limiter = RateLimiter(requests_per_second)
+
+    def fetch(offset, delay=0):
+        time.sleep(delay)
+        slept = delay + limiter.wait()
+        if metrics is not None:
+            metrics.record_sleep(slept)
+        return fetch_chunk(offset)
+
+    pending_offsets = list(offsets)
+    pending_offsets.reverse() # So that pop() hands them out in order.
+    failures = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    in_flight = {}
+    try:
+        while pending_offsets or in_flight:
+            while pending_offsets and len(in_flight) < max(1, concurrency):
+                offset = pending_offsets.pop()
+                in_flight[executor.submit(fetch, offset)] = offset
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                offset = in_flight.pop(future)
+                try:
+                    records = future.result()
+                except Exception as e:
+                    print(format_exception()) # Dump exception details to the console.
+                    if not is_retryable(e):
+                        raise ChunkFetchError(f"The request for the chunk at offset {offset} was refused.") from e
+                    failures[offset] = failures.get(offset, 0) + 1
+                    if failures[offset] >= failure_limit:
+                        raise ChunkFetchError(f"Failed to fetch the chunk at offset {offset} {failure_limit} times.")
+                    if metrics is not None:
+                        metrics.record_retry()
+                    delay = backoff_delay(failures[offset], getattr(e, 'retry_after', None))
+                    in_flight[executor.submit(fetch, offset, delay)] = offset # Retry it next.
+                    continue
+                failures.pop(offset, None)
+                yield offset, records
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def fetch_pages(fetch_page, row_count, pager=None, concurrency=4, requests_per_second=10, failure_limit=5, metrics=None, start_offset=0):
+    """The offset-paging version of fetch_chunks: calls fetch_page(offset,
+    limit) to cover rows start_offset through row_count - 1, with the limit of each
+    request picked by pager (an AdaptivePager), and yields (offset, records)
+    pairs in the order in which the pages arrive.
+
+    A page that fails is retried (after a jittered exponential backoff, or
+    as long as the error's retry_after says) with the pager's reduced page
+    size, and the rest of it is requested separately. An error that isn't
+    retryable raises ChunkFetchError right away. A page that comes
+    back short (because the server caps the limit) has its remainder
+    requested separately too."""
+    if pager is None:
+        pager = AdaptivePager()
+    limiter = RateLimiter(requests_per_second)
+
+    def fetch(offset, limit, delay=0):
+        time.sleep(delay)
+        slept = delay + limiter.wait()
+        if metrics is not None:
+            metrics.record_sleep(slept)
+        start = time.perf_counter()
+        records = fetch_page(offset, limit)
+        return records, time.perf_counter() - start
+
+    next_offset = start_offset
+    redo = [] # Pages (or parts of pages) to request again, as (offset, limit, delay) tuples.
+    failures = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, concurrency))
+    in_flight = {}
+    try:
+        while next_offset < row_count or redo or in_flight:
+            while (redo or next_offset < row_count) and len(in_flight) < max(1, concurrency):
+                if redo:
+                    offset, limit, delay = redo.pop()
+                else:
+                    offset, limit, delay = next_offset, min(pager.size, row_count - next_offset), 0
+                    next_offset += limit
+                in_flight[executor.submit(fetch, offset, limit, delay)] = (offset, limit)
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                offset, limit = in_flight.pop(future)
+                try:
+                    records, seconds = future.result()
+                except Exception as e:
+                    print(format_exception()) # Dump exception details to the console.
+                    if not is_retryable(e):
+                        raise ChunkFetchError(f"The request for the chunk at offset {offset} was refused.") from e
+                    failures[offset] = failures.get(offset, 0) + 1
+                    if failures[offset] >= failure_limit:
+                        raise ChunkFetchError(f"Failed to fetch the chunk at offset {offset} {failure_limit} times.")
+                    if metrics is not None:
+                        metrics.record_retry()
+                    pager.record_failure()
+                    delay = backoff_delay(failures[offset], getattr(e, 'retry_after', None))
+                    retry_limit = min(limit, pager.size)
+                    if retry_limit < limit:
+                        redo.append((offset + retry_limit, limit - retry_limit, delay))
+                    redo.append((offset, retry_limit, delay)) # Retry it next.
+                    continue
+                failures.pop(offset, None)
+                pager.record_page(seconds)
+                if 0 < len(records) < limit:
+                    pager.record_cap(len(records))
+                    redo.append((offset + len(records), limit - len(records), 0))
+                yield offset, records
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def fetch_chunks_by_id(fetch_chunk_after, last_id=0, pager=None, requests_per_second=10, failure_limit=5, metrics=None):
+    """Walks a datastore in _id order by calling fetch_chunk_after(last_id,
+    limit) (which should return up to limit records with _id > last_id,
+    sorted by _id, where the limit is picked by pager, an AdaptivePager)
+    and yields (last_id, records) pairs, where last_id is the _id of the
+    final record in the chunk.
+
+    Since each request depends on the one before it, the chunks are
+    fetched one at a time. A chunk that fails is retried from the same
+    _id (after a jittered exponential backoff, or as long as the error's
+    retry_after says) until it has failed failure_limit times in a row, at
+    which point ChunkFetchError is raised (as it is right away for an error
+    that isn't retryable). Retries and time spent waiting
+    on the rate limiter or backing off are recorded in metrics (a
+    CheckMetrics), if given.
+
+    A short chunk doesn't necessarily mean the end of the data (the server
+    may be capping the limit), so the walk ends with the first empty one."""
+    if pager is None:
+        pager = AdaptivePager()
+    limiter = RateLimiter(requests_per_second)
+    failures = 0
+    delay = 0
+    short_chunk = None
+    while True:
+        time.sleep(delay)
+        slept = delay + limiter.wait()
+        if metrics is not None:
+            metrics.record_sleep(slept)
+        limit = pager.size
+        start = time.perf_counter()
+        try:
+            records = fetch_chunk_after(last_id, limit)
+        except Exception as e:
+            print(format_exception()) # Dump exception details to the console.
+            if not is_retryable(e):
+                raise ChunkFetchError(f"The request for the chunk after _id {last_id} was refused.") from e
+            failures += 1
+            if failures >= failure_limit:
+                raise ChunkFetchError(f"Failed to fetch the chunk after _id {last_id} {failure_limit} times.")
+            if metrics is not None:
+                metrics.record_retry()
+            pager.record_failure()
+            delay = backoff_delay(failures, getattr(e, 'retry_after', None))
+            continue
+        failures = 0
+        delay = 0
+        pager.record_page(time.perf_counter() - start)
+        if not records:
+            return
+        if short_chunk is not None: # The last chunk was short, but there was more data after it.
+            pager.record_cap(short_chunk)
+        short_chunk = len(records) if len(records) < limit else None
+        last_id = records[-1]['_id']
+        yield last_id, records
+
+def fetch_chunks_in_ranges(fetch_chunk_between, ranges, last_id=0, pager=None, requests_per_second=10, failure_limit=5, metrics=None):
+    """Walks the given (first _id, last _id) ranges of a datastore in _id
+    order, one range after another, by calling
+    fetch_chunk_between(last_id, high, limit) (which should return up to
+    limit records with last_id < _id <= high, sorted by _id), and yields
+    (last_id, records) pairs like fetch_chunks_by_id does (which is what
+    walks each range, so failures are handled the same way). Rows with
+    _id values up to last_id are skipped."""
+    if pager is None:
+        pager = AdaptivePager()
+    for low, high in ranges:
+        if high <= last_id:
+            continue
+        # A walk that has reached the end of its range is done without
+        # asking the server for the empty chunk after it.
+        fetch_chunk_after = lambda after, limit, high=high: fetch_chunk_between(after, high, limit) if after < high else []
+        yield from fetch_chunks_by_id(fetch_chunk_after, max(low - 1, last_id), pager, requests_per_second, failure_limit, metrics)
+
+def sample_ids(min_id, max_id, sample_size, head_tail_size=0, rng=None):
+    """Returns a sorted list of _id values to check: one drawn at random from
+    each of sample_size equal strata of the _id space (so the sample is
+    spread across the whole table, old rows and new), plus the first and
+    last head_tail_size _id values. Gaps in the _id sequence (from deleted
+    rows) can make the number of rows actually found a bit smaller."""
+    if rng is None:
+        rng = random.Random()
+    if max_id < min_id:
+        return []
+    span = max_id - min_id + 1
+    sample_size = min(sample_size, span)
+    ids = set()
+    for k in range(sample_size):
+        low = min_id + (k * span) // sample_size
+        high = min_id + ((k + 1) * span) // sample_size - 1
+        ids.add(rng.randint(low, max(low, high)))
+    ids.update(range(min_id, min(min_id + head_tail_size, max_id + 1)))
+    ids.update(range(max(max_id - head_tail_size + 1, min_id), max_id + 1))
+    return sorted(ids)
+
+def chunked(xs, size):
+    # Splits xs into tuples of up to size elements.
+    return [tuple(xs[k:k+size]) for k in range(0, len(xs), size)]
@@ -0,0 +1,238 @@
+import re, math
+
+from collections import Counter
+
+MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+def hash_64(value):
+    # Python's hash() of a small integer is the integer itself, so it gets
+    # run through the splitmix64 finalizer to spread its bits out.
+    h = hash(value) & MASK_64
+    h = ((h ^ (h >> 30)) * 0xbf58476d1ce4e5b9) & MASK_64
+    h = ((h ^ (h >> 27)) * 0x94d049bb133111eb) & MASK_64
+    return h ^ (h >> 31)
+
+class HyperLogLog():
+    """Estimates the number of distinct values seen, using 2^precision
+    one-byte registers (16 KB by default) however many values there are.
+    The standard error is about 1.04/sqrt(2^precision) (0.8% by default).
+    Since it relies on hash(), estimates are only comparable within one
+    process."""
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 18:
+            raise ValueError("The precision of a HyperLogLog should be from 4 to 18, not {}.".format(precision))
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+
+    def update(self, values):
+        p, registers = self.precision, self.registers
+        width = 64 - p
+        mask = (1 << width) - 1
+        for value in values:
+            h = hash_64(value)
+            index = h >> width
+            rank = width - (h & mask).bit_length() + 1 # The position of the first 1 bit.
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def estimate(self):
+        m = self.m
+        alpha = 0.7213/(1 + 1.079/m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros > 0:
+            estimate = m * math.log(m / zeros) # Linear counting works better for small counts.
+        return estimate
+
+class HeavyHitters():
+    """Keeps approximate counts of the most frequent values in at most k
+    counters (the Misra-Gries frequent-items summary, a close relative of
+    Space-Saving). Each chunk is counted exactly (by Counter) and merged in,
+    and whenever there are more than k counters, the (k+1)th largest count
+    is subtracted from all of them and the ones that drop to zero are let
+    go. Any value that makes up more than 1/(k+1) of the values is kept,
+    and each count is low by at most total/(k+1)."""
+    def __init__(self, k=100):
+        self.k = k
+        self.counts = Counter()
+        self.total = 0
+
+    def update(self, values):
+        chunk_counts = Counter(values)
+        self.total += sum(chunk_counts.values())
+        self.counts.update(chunk_counts)
+        if len(self.counts) > self.k:
+            cutoff = sorted(self.counts.values(), reverse=True)[self.k]
+            self.counts = Counter({value: count - cutoff for value, count in self.counts.items() if count > cutoff})
+
+    def top(self, n=10):
+        # The n most frequent values, with their (lower-bound) counts.
+        return self.counts.most_common(n)
+
+class TDigest():
+    """Estimates quantiles of a stream of numbers with a merging t-digest:
+    the numbers are buffered and then merged, in sorted order, into at most
+    about compression centroids, which are kept small near the extremes
+    (so that quantiles like p1 and p99 stay accurate) and allowed to grow
+    in the middle."""
+    def __init__(self, compression=100, buffer_size=5000):
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.means = []
+        self.weights = []
+        self.buffer = []
+        self.count = 0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, numbers):
+        self.buffer.extend(numbers)
+        if len(self.buffer) >= self.buffer_size:
+            self.compress()
+
+    def scale(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def inverse_scale(self, k):
+        if k >= self.compression / 4:
+            return 1.0
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def compress(self):
+        if not self.buffer:
+            return
+        self.count += len(self.buffer)
+        self.min = min(self.min, min(self.buffer))
+        self.max = max(self.max, max(self.buffer))
+        points = sorted(zip(self.means + self.buffer, self.weights + [1] * len(self.buffer)))
+        self.buffer = []
+        total = self.count
+        means, weights = [], []
+        mean, weight = points[0]
+        weight_so_far = 0
+        limit = total * self.inverse_scale(self.scale(0) + 1)
+        for next_mean, next_weight in points[1:]:
+            if weight_so_far + weight + next_weight <= limit:
+                weight += next_weight
+                mean += (next_mean - mean) * next_weight / weight
+            else:
+                means.append(mean)
+                weights.append(weight)
+                weight_so_far += weight
+                limit = total * self.inverse_scale(self.scale(weight_so_far / total) + 1)
+                mean, weight = next_mean, next_weight
+        means.append(mean)
+        weights.append(weight)
+        self.means, self.weights = means, weights
+
+    def quantile(self, q):
+        # Returns the estimated qth quantile (for q from 0 to 1), or None if
+        # no numbers have been seen.
+        self.compress()
+        if self.count == 0:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        target = q * self.count
+        # Each centroid's mean is taken to sit at the middle of its weight,
+        # and quantiles in between are interpolated.
+        previous_position, previous_mean = 0, self.min
+        cumulative = 0
+        for mean, weight in zip(self.means, self.weights):
+            position = cumulative + weight / 2
+            if target <= position:
+                if position == previous_position:
+                    return mean
+                return previous_mean + (mean - previous_mean) * (target - previous_position) / (position - previous_position)
+            previous_position, previous_mean = position, mean
+            cumulative += weight
+        if self.count == previous_position:
+            return self.max
+        return previous_mean + (self.max - previous_mean) * (target - previous_position) / (self.count - previous_position)
+
+def to_numbers(values):
+    # The finite numbers among the values (which can be numbers or strings).
+    try:
+        numbers = list(map(float, values))
+    except (ValueError, TypeError):
+        numbers = []
+        for value in values:
+            try:
+                numbers.append(float(value))
+            except (ValueError, TypeError):
+                pass
+    return [n for n in numbers if math.isfinite(n)]
+
+class ColumnProfile():
+    """Statistics of a column, gathered in one pass over chunks of its
+    values, in memory that doesn't grow with the number of rows: exact
+    counts (of values, nulls, and numbers) and min/max/mean, a HyperLogLog
+    estimate of the number of distinct values, the most frequent values,
+    and a t-digest of the numeric values for quantiles.
+
+    The statistics (see statistic()) are
+        count, nulls, null_rate, distinct, distinct_ratio (distinct values
+        per non-null value), numeric_rate (the fraction of non-null values
+        that are numbers), min, max, mean, top_share (the fraction of
+        non-null values that are the most frequent one), and pN (the Nth
+        percentile of the numbers, like p50 or p99.9)."""
+    statistic_names = ['count', 'nulls', 'null_rate', 'distinct', 'distinct_ratio', 'numeric_rate', 'min', 'max', 'mean', 'top_share']
+    quantile_pattern = re.compile(r'p(\d+(?:\.\d+)?)$')
+
+    def __init__(self, precision=14, top_k=100, compression=100):
+        self.count = 0
+        self.nulls = 0
+        self.numbers = 0
+        self.sum = 0.0
+        self.distinct_values = HyperLogLog(precision)
+        self.heavy_hitters = HeavyHitters(top_k)
+        self.digest = TDigest(compression)
+
+    def update(self, values):
+        non_null = [x for x in values if x is not None and x != '']
+        self.count += len(values)
+        self.nulls += len(values) - len(non_null)
+        self.distinct_values.update(non_null)
+        self.heavy_hitters.update(non_null)
+        numbers = to_numbers(non_null)
+        self.numbers += len(numbers)
+        self.sum += math.fsum(numbers)
+        self.digest.update(numbers)
+
+    @classmethod
+    def is_statistic(cls, name):
+        match = cls.quantile_pattern.match(name)
+        return name in cls.statistic_names or (match is not None and float(match.group(1)) <= 100)
+
+    def statistic(self, name):
+        # Returns the named statistic (None if there's nothing to base it on).
+        non_null = self.count - self.nulls
+        if name == 'count':
+            return self.count
+        if name == 'nulls':
+            return self.nulls
+        if name == 'null_rate':
+            return self.nulls / self.count if self.count else None
+        if name == 'distinct':
+            return round(self.distinct_values.estimate())
+        if name == 'distinct_ratio':
+            return min(1.0, self.distinct_values.estimate() / non_null) if non_null else None
+        if name == 'numeric_rate':
+            return self.numbers / non_null if non_null else None
+        if name in ['min', 'max']:
+            return self.digest.quantile(0 if name == 'min' else 1)
+        if name == 'mean':
+            return self.sum / self.numbers if self.numbers else None
+        if name == 'top_share':
+            top = self.heavy_hitters.top(1)
+            return top[0][1] / non_null if top and non_null else None
+        match = self.quantile_pattern.match(name)
+        if match is not None:
+            return self.digest.quantile(float(match.group(1)) / 100)
+        raise ValueError("Unknown statistic '{}'.".format(name))
+
+    def top_values(self, n=5):
+        return self.heavy_hitters.top(n)
@@ -0,0 +1,226 @@
+import os, re, json, time, shutil, tempfile, threading
+
+# The datastore types whose values can be stored in an Arrow column without
+# changing them (a 'numeric' value can come back from CKAN as an int or a
+# float, so columns like that are left to the JSON format).
+arrow_types = {
+    'text': 'string', 'varchar': 'string', 'timestamp': 'string', 'date': 'string', 'time': 'string',
+    'int': 'int64', 'int2': 'int64', 'int4': 'int64', 'int8': 'int64', 'bigint': 'int64', 'smallint': 'int64',
+    'bool': 'bool', 'boolean': 'bool',
+    }
+
+def load_pyarrow():
+    # pyarrow is optional. Without it, snapshots are stored as JSON lines.
+    try:
+        import pyarrow, pyarrow.ipc
+        return pyarrow
+    except ImportError:
+        return None
+
+class Snapshot():
+    """A stored copy of some of the columns of a datastore (always
+    including _id), as they were when the resource had the given
+    last_modified timestamp and row count. The chunks were stored in the
+    order of the scan that fetched them, which is _id order."""
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+        self.fields = manifest['fields']
+
+    def chunks(self, fields=None, chunk_size=5000, paging='offset'):
+        # Yields (key, records) pairs like the fetching functions in scan.py
+        # do, where the key is the offset of the chunk (or, when keyset
+        # paging, the _id of its last record) and each record has the given
+        # fields (by default, all of them).
+        fields = fields or self.fields
+        offset = 0
+        for records in self.records(fields, chunk_size):
+            yield (records[-1]['_id'] if paging == 'keyset' else offset), records
+            offset += len(records)
+
+    def records(self, fields, chunk_size):
+        path = os.path.join(self.directory, self.manifest['file'])
+        if self.manifest['format'] == 'arrow':
+            # The file is memory-mapped, so only the batch being read is
+            # paged in.
+            pa = load_pyarrow()
+            with pa.memory_map(path) as source:
+                reader = pa.ipc.open_file(source)
+                for index in self.manifest['order']:
+                    batch = reader.get_batch(index).select(fields)
+                    for k in range(0, batch.num_rows, chunk_size):
+                        yield batch.slice(k, chunk_size).to_pylist()
+        else:
+            with open(path, 'r') as f:
+                for position in self.manifest['order']:
+                    f.seek(position)
+                    columns = json.loads(f.readline())
+                    rows = list(zip(*[columns[field] for field in fields]))
+                    for k in range(0, len(rows), chunk_size):
+                        yield [dict(zip(fields, row)) for row in rows[k:k+chunk_size]]
+
+class SnapshotWriter():
+    """Stores the chunks of a scan (in whatever order they arrive) as a new
+    snapshot, in a temporary directory that replaces the resource's old
+    snapshot on commit(). If anything goes wrong, the snapshot is
+    abandoned (and the scan itself goes on)."""
+    def __init__(self, cache, resource_id, last_modified, row_count, fields, schema=None):
+        self.cache = cache
+        self.resource_id = resource_id
+        self.last_modified = last_modified
+        self.row_count = row_count
+        self.fields = ['_id'] + [f for f in fields if f != '_id']
+        self.directory = tempfile.mkdtemp(prefix='.{}.'.format(cache.directory_name(resource_id)), dir=cache.directory)
+        self.keys = []
+        self.positions = []
+        self.rows = 0
+        self.failed = False
+        types = {s['id']: s['type'] for s in schema or []}
+        self.pa = load_pyarrow()
+        if self.pa is not None and all(types.get(f) in arrow_types for f in self.fields):
+            self.format, self.file = 'arrow', 'columns.arrow'
+            self.schema = self.pa.schema([(f, arrow_types[types[f]]) for f in self.fields])
+            self.writer = self.pa.ipc.new_file(os.path.join(self.directory, self.file), self.schema)
+        else:
+            self.format, self.file = 'jsonl', 'columns.jsonl'
+            self.writer = open(os.path.join(self.directory, self.file), 'w')
+
+    def add(self, key, records):
+        if self.failed or not records:
+            return
+        try:
+            columns = {f: [r[f] for r in records] for f in self.fields}
+            if self.format == 'arrow':
+                self.writer.write_batch(self.pa.record_batch([columns[f] for f in self.fields], schema=self.schema))
+            else:
+                self.positions.append(self.writer.tell())
+                self.writer.write(json.dumps(columns) + '\n')
+        except Exception as e: # Like a value that doesn't fit the column's type.
+            print("Unable to store the snapshot: {}".format(e))
+            self.abandon()
+            return
+        self.keys.append(key)
+        self.rows += len(records)
+
+    def commit(self):
+        if self.failed:
+            return
+        self.writer.close()
+        if self.rows != self.row_count: # The datastore changed during the scan.
+            self.abandon()
+            return
+        order = sorted(range(len(self.keys)), key=self.keys.__getitem__)
+        manifest = {'resource_id': self.resource_id,
+                'last_modified': self.last_modified,
+                'row_count': self.row_count,
+                'fields': self.fields,
+                'format': self.format,
+                'file': self.file,
+                'order': order if self.format == 'arrow' else [self.positions[k] for k in order],
+                'bytes': os.path.getsize(os.path.join(self.directory, self.file)),
+                'stored_at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        with open(os.path.join(self.directory, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f)
+        self.cache.replace(self.resource_id, self.directory)
+
+    def abandon(self):
+        self.failed = True
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class SnapshotCache():
+    """An on-disk cache of the columns that scans have fetched, holding
+    the latest snapshot of each resource (in its own directory, with a
+    manifest.json). A snapshot is only used while the resource still has
+    the last_modified timestamp and row count that it was stored with, and
+    only by scans that need no fields that it lacks.
+
+    Snapshots are stored as Arrow IPC files (read through memory maps) if
+    pyarrow is installed and the columns have simple types, or as JSON
+    lines otherwise. Whenever the snapshots add up to more than max_bytes,
+    the least recently used ones are deleted, along with any temporary
+    directories (of snapshots still being written) that have gone
+    untouched for stale_after seconds, like ones left behind by a run that
+    was killed.
+
+    For a post-mortem, find(...).chunks() gives back the records that were
+    checked."""
+    def __init__(self, directory='snapshots', max_bytes=2*1024**3, stale_after=24*3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stale_after = stale_after
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            self.evict()
+
+    def directory_name(self, resource_id):
+        return re.sub(r'[^\w-]', '_', resource_id)
+
+    def path(self, resource_id):
+        return os.path.join(self.directory, self.directory_name(resource_id))
+
+    def find(self, resource_id, last_modified, row_count, fields=()):
+        # Returns the Snapshot of the resource if it is up to date and has
+        # all the fields (or else None).
+        manifest_path = os.path.join(self.path(resource_id), 'manifest.json')
+        try:
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if manifest['last_modified'] != last_modified or manifest['row_count'] != row_count:
+            return None
+        if set(fields) - set(manifest['fields']):
+            return None
+        if manifest['format'] == 'arrow' and load_pyarrow() is None:
+            return None
+        os.utime(manifest_path) # Mark it as recently used.
+        return Snapshot(self.path(resource_id), manifest)
+
+    def writer(self, resource_id, last_modified, row_count, fields, schema=None):
+        return SnapshotWriter(self, resource_id, last_modified, row_count, fields, schema)
+
+    def replace(self, resource_id, new_directory):
+        with self.lock:
+            path = self.path(resource_id)
+            shutil.rmtree(path, ignore_errors=True)
+            os.rename(new_directory, path)
+            self.evict()
+
+    def last_touched(self, path):
+        # The latest modification time of a directory or the files in it.
+        times = [os.path.getmtime(path)]
+        for name in os.listdir(path):
+            times.append(os.path.getmtime(os.path.join(path, name)))
+        return max(times)
+
+    def evict(self):
+        # Deletes stale temporary directories, and then the least recently
+        # used snapshots until the rest fit in max_bytes.
+        snapshots = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'): # A snapshot that was being written.
+                path = os.path.join(self.directory, name)
+                try:
+                    if os.path.isdir(path) and time.time() - self.last_touched(path) > self.stale_after:
+                        shutil.rmtree(path, ignore_errors=True)
+                except OSError: # (Like if it was just committed or abandoned.)
+                    pass
+                continue
+            manifest_path = os.path.join(self.directory, name, 'manifest.json')
+            try:
+                with open(manifest_path, 'r') as f:
+                    size = json.load(f)['bytes']
+                snapshots.append((os.path.getmtime(manifest_path), size, name))
+            except (OSError, ValueError, KeyError):
+                continue
+        total = sum(size for _, size, _ in snapshots)
+        for _, size, name in sorted(snapshots):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+            total -= size
@@ -0,0 +1,120 @@
+import re
+
+from datetime import datetime, timedelta, timezone
+
+# How often a package promises to be updated, by the (normalized) value of
+# its frequency_publishing or frequency_data_change field. Frequencies that
+# make no promise (like 'As Needed' or 'Not Updated (Historical Only)')
+# are left out, so those packages are never overdue.
+update_periods = {
+    'hourly': timedelta(hours=1),
+    'multiple times per day': timedelta(days=1),
+    'daily': timedelta(days=1),
+    'weekdays': timedelta(days=3), # (To get over a weekend.)
+    'weekly': timedelta(days=7),
+    'biweekly': timedelta(days=14),
+    'semimonthly': timedelta(days=16),
+    'monthly': timedelta(days=31),
+    'bimonthly': timedelta(days=62),
+    'quarterly': timedelta(days=92),
+    'semiannually': timedelta(days=183),
+    'biannually': timedelta(days=183),
+    'annually': timedelta(days=366),
+    'yearly': timedelta(days=366),
+    }
+
+# The package fields that a sweep needs.
+sweep_fields = ['id', 'name', 'title', 'metadata_modified', 'private', 'frequency_publishing', 'frequency_data_change']
+
+def update_period(frequency):
+    # Returns the timedelta that the frequency (like 'Bi-Weekly') promises,
+    # or None.
+    if not frequency:
+        return None
+    normalized = re.sub(r'[^a-z ]', '', str(frequency).lower()).strip()
+    return update_periods.get(normalized)
+
+def package_field(package, name):
+    # Custom fields can come back as top-level fields, as 'extras_'-prefixed
+    # fields (when package_search returns only the fields listed in 'fl'),
+    # or in the 'extras' list.
+    if package.get(name) not in [None, '']:
+        return package[name]
+    if package.get('extras_' + name) not in [None, '']:
+        return package['extras_' + name]
+    for extra in package.get('extras') or []:
+        if isinstance(extra, dict) and extra.get('key') == name:
+            return extra.get('value')
+    return None
+
+def parse_timestamp(value):
+    # CKAN timestamps are in UTC, usually without a time zone.
+    timestamp = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+def search_packages(ckan, rows=1000, fq=None, include_private=False, fields=None):
+    """Yields the packages in the catalog, paging through package_search
+    rows at a time (in name order, so that the pages don't overlap). If
+    fields is given, only those fields are asked for (with 'fl'), unless the
+    CKAN instance doesn't support that, in which case whole packages are
+    fetched. CKAN may return fewer than rows packages per request (as
+    limited by ckan.search.rows_max), so each page starts where the last
+    one actually ended."""
+    from ckanapi.errors import ValidationError
+    start = 0
+    fl = ','.join(fields + ['extras_' + f for f in fields if f.startswith('frequency_')]) if fields else None
+    while True:
+        parameters = {'q': '*:*', 'rows': rows, 'start': start, 'sort': 'name asc', 'include_private': include_private}
+        if fq is not None:
+            parameters['fq'] = fq
+        if fl is not None:
+            parameters['fl'] = fl
+        try:
+            response = ckan.action.package_search(**parameters)
+        except ValidationError:
+            if fl is None:
+                raise
+            print("This CKAN instance doesn't accept 'fl', so whole packages will be fetched.")
+            fl = None
+            continue
+        packages = response['results']
+        yield from packages
+        start += len(packages)
+        if not packages or start >= response['count']:
+            return
+
+def overdue_packages(packages, now=None, grace=0.5):
+    """Returns a list (most overdue first) of the packages that haven't
+    been modified within the period promised by their frequency_publishing
+    (or, if that's missing, their frequency_data_change), plus grace times
+    that period, with how long ago each was modified, in periods."""
+    if now is None:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+    overdue = []
+    for package in packages:
+        frequency = package_field(package, 'frequency_publishing') or package_field(package, 'frequency_data_change')
+        period = update_period(frequency)
+        if period is None or not package.get('metadata_modified'):
+            continue
+        age = now - parse_timestamp(package['metadata_modified'])
+        if age > period * (1 + grace):
+            overdue.append({'id': package.get('id'),
+                'name': package.get('name'),
+                'title': package.get('title'),
+                'frequency': frequency,
+                'metadata_modified': package['metadata_modified'],
+                'days_since_modified': age.total_seconds()/86400,
+                'periods_overdue': age / period})
+    return sorted(overdue, key=lambda p: p['periods_overdue'], reverse=True)
+
+def staleness_digest(overdue, site=None, packages_checked=None):
+    # One message listing every overdue package.
+    checked = " of the {} packages swept".format(packages_checked) if packages_checked is not None else " packages"
+    lines = ["{}{} are overdue for an update:".format(len(overdue), checked)]
+    for p in overdue:
+        url = "{}/dataset/{}".format(site.rstrip('/'), p['name']) if site else p['name']
+        lines.append("    {} ({}): {}, last modified {} ({:.0f} days ago, {:.1f} periods)".format(p['title'], url,
+            p['frequency'], p['metadata_modified'][:10], p['days_since_modified'], p['periods_overdue']))
+    return '\n'.join(lines)
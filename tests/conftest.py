@@ -0,0 +1,29 @@
+import os, sys, types
+
+# The tests import the modules at the top of the repository.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# beekeeper and fetch get their site, keys, and directories from the
+# credentials and parameters modules, which are replaced here by ones that
+# point nowhere (like in benchmark.run_scenario), so that the tests can
+# never reach a real CKAN instance, SFTP server, or Slack webhook. Every
+# test passes the site or source that it uses explicitly.
+credentials = types.ModuleType('credentials')
+credentials.site = 'http://127.0.0.1:9'
+credentials.ckan_api_key = None
+credentials.production = False
+sys.modules['credentials'] = credentials
+
+parameters = types.ModuleType('parameters')
+parameters.__path__ = []
+local_parameters = types.ModuleType('parameters.local_parameters')
+local_parameters.CITY_KEYFILEPATH = None
+local_parameters.REFERENCE_DIR = 'reference_files'
+remote_parameters = types.ModuleType('parameters.remote_parameters')
+remote_parameters.webhook_url = 'http://127.0.0.1:9'
+remote_parameters.webhook_by_group = {}
+parameters.local_parameters = local_parameters
+parameters.remote_parameters = remote_parameters
+sys.modules['parameters'] = parameters
+sys.modules['parameters.local_parameters'] = local_parameters
+sys.modules['parameters.remote_parameters'] = remote_parameters
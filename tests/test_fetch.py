@@ -0,0 +1,53 @@
+import json
+
+from fetch import DirectorySource, fetch_reference_file, get_data_by_field
+
+class RecordingSource(DirectorySource):
+    # A DirectorySource that keeps track of the offsets that files are
+    # opened at.
+    def __init__(self, root):
+        super().__init__(root)
+        self.offsets = []
+
+    def open(self, remote_path, offset=0):
+        self.offsets.append(offset)
+        return super().open(remote_path, offset)
+
+def write_reference_file(directory, rows=1000):
+    directory.mkdir()
+    text = 'OwnerZip,DogName\n' + ''.join('{},DOG {}\n'.format(15200 + k % 37, k) for k in range(rows))
+    (directory / 'dogs.csv').write_text(text)
+    return text
+
+def test_fetch_reference_file(tmp_path):
+    text = write_reference_file(tmp_path / 'remote')
+    source = RecordingSource(str(tmp_path / 'remote'))
+    local_filepath = fetch_reference_file(source, '/dogs.csv', str(tmp_path / 'local'), block_size=100)
+    assert open(local_filepath).read() == text
+    # An unchanged file isn't fetched again.
+    assert fetch_reference_file(source, '/dogs.csv', str(tmp_path / 'local')) == local_filepath
+    assert source.offsets == [0]
+
+def test_fetch_reference_file_resumes(tmp_path):
+    text = write_reference_file(tmp_path / 'remote')
+    source = RecordingSource(str(tmp_path / 'remote'))
+    # Leave behind the first part of an earlier download of the same file.
+    (tmp_path / 'local').mkdir()
+    part_filepath = tmp_path / 'local' / 'dogs.csv.part'
+    part_filepath.write_text(text[:500])
+    size, mtime = source.stat('/dogs.csv')
+    (tmp_path / 'local' / 'dogs.csv.part.remote.json').write_text(json.dumps({'size': size, 'mtime': mtime}))
+
+    local_filepath = fetch_reference_file(source, '/dogs.csv', str(tmp_path / 'local'))
+    assert source.offsets == [500]
+    assert open(local_filepath).read() == text
+    assert not part_filepath.exists()
+
+def test_get_data_by_field(tmp_path):
+    write_reference_file(tmp_path / 'remote')
+    local_filepath = fetch_reference_file(DirectorySource(str(tmp_path / 'remote')), 'dogs.csv', str(tmp_path / 'local'))
+    for k in range(2): # Parsed the first time, and read from the cache the second.
+        values = get_data_by_field(local_filepath, 'OwnerZip')
+        assert len(values) == 1000
+        assert get_data_by_field(local_filepath, 'OwnerZip', as_set=True) == set(values)
+        assert len(set(values)) == 37
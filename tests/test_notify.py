@@ -0,0 +1,64 @@
+import json, threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from notify import NotificationQueue
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    # A stand-in for a Slack webhook, which keeps the payloads posted to it
+    # and answers the first server.throttled of them with 429 responses.
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        payload = json.loads(self.rfile.read(length))
+        server = self.server
+        with server.lock:
+            throttle = server.throttled > 0
+            if throttle:
+                server.throttled -= 1
+            else:
+                server.payloads.append(payload)
+        self.send_response(429 if throttle else 200)
+        if throttle:
+            self.send_header('Retry-After', '0')
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+def start_webhook(throttled=0):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), WebhookHandler)
+    server.daemon_threads = True
+    server.payloads = []
+    server.throttled = throttled
+    server.lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}/hook'.format(server.server_address[1])
+
+def test_notifications_are_combined_into_digests():
+    server, webhook_url = start_webhook()
+    try:
+        notifications = NotificationQueue(webhook_url=webhook_url, flush_interval=60, messages_per_second=100)
+        notifications.put("The first check failed.", channel='#alerts')
+        notifications.put("The second check failed.", channel='#alerts')
+        notifications.put("Something else happened.", channel='#other')
+        assert notifications.flush(timeout=30)
+    finally:
+        server.shutdown()
+    by_channel = {p['channel']: p['text'] for p in server.payloads}
+    assert len(server.payloads) == 2
+    assert "The first check failed.\n\nThe second check failed." in by_channel['#alerts']
+    assert "Something else happened." in by_channel['#other']
+
+def test_throttled_notifications_are_retried():
+    server, webhook_url = start_webhook(throttled=2)
+    try:
+        notifications = NotificationQueue(webhook_url=webhook_url, flush_interval=60, messages_per_second=100)
+        notifications.put("This check failed.")
+        assert notifications.flush(timeout=30)
+    finally:
+        server.shutdown()
+    assert server.throttled == 0
+    assert len(server.payloads) == 1
+    assert "This check failed." in server.payloads[0]['text']
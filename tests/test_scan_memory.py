@@ -0,0 +1,50 @@
+import tracemalloc
+
+import pytest
+
+import beekeeper
+from benchmark import start_fake_ckan
+from ckan_util import get_ckan
+
+def scan_peak(rows, paging):
+    # Scans a synthetic resource with the given number of rows through the
+    # fake datastore (which runs in a process of its own, so that only the
+    # scan's allocations are traced) and returns the peak of the memory
+    # allocated during the scan.
+    config = {'package_id': 'memory',
+            'resources': {'synthetic': rows},
+            'latency': 0,
+            'offset_latency': 0,
+            'error_rate': 0,
+            'throttle_rate': 0,
+            'max_limit': 32000,
+            'bad_rate': 0}
+    server, site = start_fake_ckan(config)
+    try:
+        b = {'code': 'memory', 'name': 'memory', 'resource_id': 'synthetic', 'field_name': 'OwnerZip', 'assertion': 'int',
+            'evaluation': 'client', 'paging': paging, 'chunk_size': 5000, 'adaptive_paging': False, 'requests_per_second': 0}
+        ckan = get_ckan(site)
+        assertion_function = beekeeper.batch_functionalize(b)
+        # A scan of a few rows first, so that imports and connections aren't
+        # counted.
+        beekeeper.apply_function_to_all_records(site, dict(b, strategy='sample', sample_size=10), 'synthetic', 'OwnerZip',
+                assertion_function, None, strategy='sample', ckan=ckan)
+        tracemalloc.start()
+        try:
+            passed = beekeeper.apply_function_to_all_records(site, b, 'synthetic', 'OwnerZip', assertion_function, None, ckan=ckan)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    finally:
+        server.terminate()
+        server.join()
+    assert passed
+    return peak
+
+@pytest.mark.parametrize('paging', ['offset', 'keyset'])
+def test_scan_memory_does_not_grow_with_rows(paging):
+    # Chunks are checked and dropped as they arrive, so scanning 20 times as
+    # many rows shouldn't take much more memory.
+    small = scan_peak(100000, paging)
+    large = scan_peak(2000000, paging)
+    assert large < 1.5 * small, "The peak went from {} bytes for 100k rows to {} bytes for 2M rows.".format(small, large)